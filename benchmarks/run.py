@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+"""
+Benchmarks the scanner, the index and the search on synthetic trees,
+writing the results as JSON so that runs can be compared:
+
+	python -m benchmarks.run --files 10000 --files 100000 -o results.json
+
+Each tree size is generated and measured in its own process, so that
+the peak RSS reported for it is not inflated by earlier runs.
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import platform
+import optparse
+import resource
+import tempfile
+import threading
+import subprocess
+import sqlite3
+import Queue as queue
+from multiprocessing import Process
+from multiprocessing import Queue as MPQueue
+
+from file_finder.db import DB, BACKENDS, DEFAULT_BACKEND
+from file_finder.path_filter import PathFilter
+from file_finder.watcher import TreeWatcher, Event, DEFAULT_SCAN_THREADS
+from benchmarks.tree import TreeSpec, generate, NAME_STYLES
+
+DEFAULT_SIZES = [10000, 100000]
+# a fixed mix of name, multi-fragment, path, anchored and missing queries
+QUERIES = [
+	'main', 'util', 'parser', 'conf', 'req han', 'test_', 'model view', 'cache.py',
+	'src/', 'lib/util', 'core/ser', 'api/ model', 'test/ pars', '^index', '.json$',
+	'^read py$', 'x', 'st', 'srv', 'zzqxv',
+]
+# file events of each kind applied after the initial index
+EVENT_COUNT = 5000
+POLL_INTERVAL = 0.005
+
+def percentile(values, p):
+	values = sorted(values)
+	return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+def latency_summary(seconds):
+	ms = [s * 1000 for s in seconds]
+	return {
+		'count': len(ms),
+		'p50_ms': round(percentile(ms, 50), 3),
+		'p99_ms': round(percentile(ms, 99), 3),
+		'max_ms': round(max(ms), 3),
+	}
+
+def rate(count, seconds):
+	return {'count': count, 'seconds': round(seconds, 3), 'per_second': round(count / max(seconds, 1e-9), 1)}
+
+def wait_for(condition):
+	while not condition():
+		time.sleep(POLL_INTERVAL)
+
+def start(target, name):
+	thread = threading.Thread(target=target, name=name)
+	thread.daemon = True
+	thread.start()
+
+def on_reader(db, func):
+	"""run `func` on the db's search thread (which owns the reading connection)"""
+	result = queue.Queue()
+	db.dbqueue.put(lambda: result.put(func()))
+	return result.get()
+
+def bench_scan(root, path_filter, files, threads):
+	"""time for the watcher to list the whole tree, with events thrown away"""
+	event_queue = queue.Queue()
+	listed = [0]
+	def drain():
+		while True:
+			event = event_queue.get()
+			if event.names is not None:
+				listed[0] += len(event.names)
+	start(drain, 'drain')
+	watcher = TreeWatcher(root, event_queue, path_filter, threads=threads)
+	started = time.time()
+	start(watcher.scan, '[scanner] 0')
+	wait_for(lambda: listed[0] >= files)
+	return rate(files, time.time() - started)
+
+def bench_index(root, path_filter, files, threads, scratch_dir, backend):
+	"""time from an empty index until every file is searchable"""
+	event_queue = queue.Queue()
+	db = DB(event_queue, MPQueue(), MPQueue(), path_filter, scratch_dir=scratch_dir, backend=backend)
+	watcher = TreeWatcher(root, event_queue, path_filter, threads=threads)
+	started = time.time()
+	start(watcher.scan, '[scanner] 0')
+	wait_for(lambda: db.file_count >= files)
+	return db, rate(files, time.time() - started)
+
+def apply_events(db, events, expected_count):
+	started = time.time()
+	for event in events:
+		db.event_queue.put(event)
+	wait_for(lambda: db.file_count == expected_count)
+	return rate(len(events), time.time() - started)
+
+def bench_events(db, count):
+	"""throughput of the writer for individual add, move and remove events"""
+	base = db.file_count
+	names = ["bench_event_%d.txt" % (i,) for i in range(count)]
+	add = [Event(base='', name=name, event=Event.ADDED, exists=True) for name in names]
+	move = [Event(base='', name=name, event=Event.MOVED, exists=True, dest_base='', dest_name='moved_' + name)
+		for name in names]
+	# (moves don't change the file count, so a final addition marks the end of them)
+	move.append(Event(base='', name='bench_marker', event=Event.ADDED, exists=True))
+	remove = [Event(base='', name='moved_' + name, event=Event.REMOVED, exists=False) for name in names]
+	remove.append(Event(base='', name='bench_marker', event=Event.REMOVED, exists=False))
+	return {
+		'add': apply_events(db, add, base + count),
+		'move': apply_events(db, move, base + count + 1),
+		'remove': apply_events(db, remove, base),
+	}
+
+def bench_queries(db):
+	"""
+	Latency of each query from scratch, and of every keystroke
+	while typing it (where earlier results can be reused).
+	"""
+	def timed(query):
+		started = time.time()
+		db.find(query)
+		return time.time() - started
+	def run():
+		cold = []
+		typing = []
+		for query in QUERIES:
+			db._query_cache.clear()
+			cold.append(timed(query))
+			db._query_cache.clear()
+			typing.extend(timed(query[:i]) for i in range(1, len(query) + 1))
+		return cold, typing
+	cold, typing = on_reader(db, run)
+	return {'query': latency_summary(cold), 'typing': latency_summary(typing)}
+
+def bench_filter(root, path_filter):
+	"""PathFilter decisions per second, over every path in the tree"""
+	paths = []
+	for base, dirnames, filenames in os.walk(root):
+		relpath = os.path.relpath(base, root)
+		relpath = '' if relpath == os.curdir else relpath + os.path.sep
+		paths.extend((relpath + name + os.path.sep, False) for name in dirnames)
+		paths.extend((relpath + name, True) for name in filenames)
+	started = time.time()
+	for path, is_file in paths:
+		path_filter.should_include(path, is_file=is_file)
+	return rate(len(paths), time.time() - started)
+
+def measure(spec, root, opts):
+	path_filter = PathFilter()
+	result = {}
+	result['scan'] = bench_scan(root, path_filter, spec.files, opts.threads)
+	scratch_dir = tempfile.mkdtemp(prefix='file-finder-bench-')
+	try:
+		db, result['index'] = bench_index(root, path_filter, spec.files, opts.threads, scratch_dir, opts.backend)
+		result['events'] = bench_events(db, min(spec.files, opts.events))
+		result.update(bench_queries(db))
+		# (measured before the filter benchmark, which holds every path in memory)
+		result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		result['filter'] = bench_filter(root, path_filter)
+	finally:
+		shutil.rmtree(scratch_dir, ignore_errors=True)
+	return result
+
+def in_process(func, *args):
+	"""the result of func(*args), run in a child process"""
+	results = MPQueue()
+	def run():
+		try:
+			results.put((True, func(*args)))
+		except Exception, e:
+			results.put((False, "%s: %s" % (type(e).__name__, e)))
+	process = Process(target=run)
+	process.start()
+	ok, result = results.get()
+	process.join()
+	if not ok:
+		raise RuntimeError(result)
+	return result
+
+def run_size(spec, opts):
+	root = tempfile.mkdtemp(prefix='file-finder-tree-', dir=opts.dir)
+	try:
+		started = time.time()
+		dirs, files = in_process(generate, spec, root)
+		result = spec.as_dict()
+		result['dirs'] = dirs
+		result['generate_seconds'] = round(time.time() - started, 3)
+		result.update(in_process(measure, spec, root, opts))
+		return result
+	finally:
+		shutil.rmtree(root, ignore_errors=True)
+
+def revision():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+			cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, 'w')).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def summary(result):
+	return ("%(files)d files: scan %(scan)s/s, index %(index)s/s, query p50 %(p50)sms p99 %(p99)sms, "
+		"typing p99 %(typing)sms, rss %(rss)dMB") % {
+		'files': result['files'],
+		'scan': result['scan']['per_second'],
+		'index': result['index']['per_second'],
+		'p50': result['query']['p50_ms'],
+		'p99': result['query']['p99_ms'],
+		'typing': result['typing']['p99_ms'],
+		'rss': result['peak_rss_kb'] // 1024,
+	}
+
+def main():
+	parser = optparse.OptionParser("python -m benchmarks.run [options]")
+	parser.add_option('-f', '--files', type='int', action='append', default=[],
+		help='files in the generated tree (repeatable; default %s)' % (', '.join(map(str, DEFAULT_SIZES)),))
+	parser.add_option('--depth', type='int', default=8, help='maximum directory depth (%default)')
+	parser.add_option('--fanout', type='int', default=8, help='maximum subdirectories per directory (%default)')
+	parser.add_option('--files-per-dir', type='int', default=20, help='average files per directory (%default)')
+	parser.add_option('--names', choices=NAME_STYLES, default='words',
+		help='file name style: %s (%%default)' % (' or '.join(NAME_STYLES),))
+	parser.add_option('--seed', type='int', default=0, help='random seed for the tree (%default)')
+	parser.add_option('-j', '--threads', type='int', default=DEFAULT_SCAN_THREADS,
+		help='scanner threads (%default)')
+	parser.add_option('--backend', choices=sorted(BACKENDS), default=DEFAULT_BACKEND,
+		help='index backend: %s (%%default)' % (' or '.join(sorted(BACKENDS)),))
+	parser.add_option('--events', type='int', default=EVENT_COUNT,
+		help='file events of each kind to apply (%default)')
+	parser.add_option('--dir', default=None, help='where to generate trees (the temp dir)')
+	parser.add_option('-o', '--output', default=None, help='write JSON results here (stdout)')
+	opts, args = parser.parse_args()
+	if args:
+		parser.error("unexpected arguments")
+
+	report = {
+		'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'revision': revision(),
+		'python': platform.python_version(),
+		'sqlite': sqlite3.sqlite_version,
+		'platform': platform.platform(),
+		'threads': opts.threads,
+		'backend': opts.backend,
+		'queries': QUERIES,
+		'runs': [],
+	}
+	for files in opts.files or DEFAULT_SIZES:
+		spec = TreeSpec(files, depth=opts.depth, fanout=opts.fanout,
+			files_per_dir=opts.files_per_dir, names=opts.names, seed=opts.seed)
+		result = run_size(spec, opts)
+		print >> sys.stderr, summary(result)
+		report['runs'].append(result)
+
+	output = json.dumps(report, indent=2, sort_keys=True)
+	if opts.output:
+		with open(opts.output, 'w') as f:
+			f.write(output + '\n')
+	else:
+		print output
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,86 @@
+"""
+Reproducible synthetic source trees: the same options and seed
+always produce the same directories and file names.
+"""
+import os
+import random
+
+WORDS = [
+	'app', 'api', 'base', 'build', 'cache', 'client', 'common', 'config', 'core',
+	'data', 'db', 'debug', 'doc', 'event', 'file', 'filter', 'format', 'handler',
+	'http', 'index', 'init', 'io', 'lib', 'list', 'log', 'main', 'manager', 'map',
+	'model', 'net', 'node', 'parse', 'parser', 'path', 'plugin', 'pool', 'query',
+	'queue', 'reader', 'render', 'request', 'resource', 'result', 'router',
+	'scan', 'schema', 'search', 'server', 'service', 'session', 'shared', 'src',
+	'state', 'store', 'stream', 'string', 'sync', 'task', 'test', 'thread',
+	'token', 'tree', 'type', 'ui', 'user', 'util', 'value', 'view', 'watch',
+	'widget', 'worker', 'writer',
+]
+EXTENSIONS = ['py', 'c', 'h', 'js', 'java', 'go', 'rb', 'txt', 'md', 'json', 'html', 'css']
+NAME_STYLES = ('words', 'random')
+
+class TreeSpec(object):
+	def __init__(self, files, depth=8, fanout=8, files_per_dir=20, names='words', seed=0):
+		if names not in NAME_STYLES:
+			raise ValueError("unknown name style: %s" % (names,))
+		self.files = files
+		self.depth = depth
+		self.fanout = fanout
+		self.files_per_dir = files_per_dir
+		self.names = names
+		self.seed = seed
+
+	def as_dict(self):
+		return dict(self.__dict__)
+
+def _skewed(rng, items):
+	# a few items are much more common than the rest, as in real trees
+	return items[int(len(items) * rng.random() ** 3)]
+
+def _name(rng, style):
+	if style == 'random':
+		length = rng.randint(4, 16)
+		return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789_') for i in range(length))
+	words = [_skewed(rng, WORDS) for i in range(rng.randint(1, 3))]
+	joiner = rng.choice(('_', '-', '', 'camel'))
+	if joiner == 'camel':
+		return words[0] + ''.join(word.capitalize() for word in words[1:])
+	return joiner.join(words)
+
+def _dirs(spec, rng):
+	"""relative paths of every directory (the root is ''), parents first"""
+	count = max(1, spec.files // max(1, spec.files_per_dir))
+	dirs = ['']
+	# directories that can still take children: [path, depth, children]
+	parents = [['', 0, 0]]
+	while len(dirs) < count and parents:
+		index = rng.randrange(len(parents))
+		parent = parents[index]
+		path = os.path.join(parent[0], "%s%d" % (_name(rng, spec.names), len(dirs)))
+		dirs.append(path)
+		parent[2] += 1
+		if parent[2] >= spec.fanout:
+			parents[index] = parents[-1]
+			parents.pop()
+		if parent[1] + 1 < spec.depth:
+			parents.append([path, parent[1] + 1, 0])
+	return dirs
+
+def generate(spec, root):
+	"""
+	Create the tree described by `spec` under `root` (which must exist),
+	returning (directory count, file count).
+	"""
+	rng = random.Random(spec.seed)
+	dirs = _dirs(spec, rng)
+	for path in dirs[1:]:
+		os.mkdir(os.path.join(root, path))
+	names = [set() for path in dirs]
+	for i in range(spec.files):
+		index = rng.randrange(len(dirs))
+		name = "%s.%s" % (_name(rng, spec.names), _skewed(rng, EXTENSIONS))
+		if name in names[index]:
+			name = "%s%d.%s" % (name.rsplit('.', 1)[0], i, name.rsplit('.', 1)[1])
+		names[index].add(name)
+		open(os.path.join(root, dirs[index], name), 'w').close()
+	return len(dirs), spec.files
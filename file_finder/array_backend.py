@@ -0,0 +1,358 @@
+import re
+import array
+import bisect
+import logging
+from contextlib import contextmanager
+from backend import Backend, adapt_str, dir_path, split_path
+from score import Scorer
+
+# ends every name in the buffers (it can't appear in a file name)
+SEPARATOR = '\0'
+# bytes of names searched between checks for an interrupted search
+SCAN_CHUNK = 1 << 20
+# removed names are only dropped from the buffers (renumbering every file)
+# once they take up this much space, and this fraction of it
+COMPACT_MIN_BYTES = 1 << 20
+COMPACT_RATIO = 0.5
+
+def to_bytes(s):
+	return s.encode("iso-8859-1") if isinstance(s, unicode) else s
+
+class FileTable(object):
+	"""
+	Every file as an entry in parallel arrays, indexed by file id. Names are
+	packed end to end into a single buffer (and a lowercased copy to match
+	against), so that a search is a regex scan over contiguous memory.
+	Files are only ever appended (removed ones have a directory of -1),
+	so a search can run alongside the writer, looking only at the
+	files that existed when it started.
+	"""
+	def __init__(self):
+		self.names = bytearray()
+		self.lower = bytearray()
+		# offset of each file's name in the buffers
+		self.starts = array.array('I')
+		# id of each file's directory
+		self.dirs = array.array('i')
+		# dir id -> ids of the files in it
+		self.dir_files = {}
+
+	def __len__(self):
+		return len(self.starts)
+
+	def name(self, file_id):
+		start = self.starts[file_id]
+		return str(self.names[start:self.names.index(SEPARATOR, start)])
+
+	def end(self, file_id):
+		"""the offset just past the separator ending a file's name"""
+		return self.lower.index(SEPARATOR, self.starts[file_id]) + 1
+
+	def append(self, dir_id, name):
+		file_id = len(self.dirs)
+		self.dirs.append(dir_id)
+		self.dir_files.setdefault(dir_id, array.array('i')).append(file_id)
+		start = len(self.names)
+		self.names += name + SEPARATOR
+		self.lower += name.lower() + SEPARATOR
+		# (the file is visible to searches from here)
+		self.starts.append(start)
+		return file_id
+
+def _pattern(fragments, anchor_start=False, anchor_end=False):
+	"""a regex finding the fragments (in order) within a single name in a buffer"""
+	pattern = '[^\0]*?'.join(re.escape(to_bytes(fragment).lower()) for fragment in fragments)
+	if anchor_start:
+		pattern = '(?:^|(?<=\0))' + pattern
+	if anchor_end:
+		pattern += '(?=\0)'
+	return re.compile(pattern)
+
+class ArrayBackend(Backend):
+	"""
+	A compact, in-memory index: directory paths are stored once, and each
+	file is just an offset, a directory id and its name in a packed buffer.
+	Nothing is kept between runs.
+	"""
+	def __init__(self, index_path=None, scratch_dir=None):
+		assert index_path is None, "the array backend can't keep a persistent index"
+		self._table = FileTable()
+		# bytes taken up by removed names
+		self._removed_bytes = 0
+		# dir id -> path (None once removed), and path -> dir id
+		self._dir_paths = []
+		self._dir_ids = {}
+		# bumped whenever a directory is added, moved or removed
+		self._dirs_version = 0
+		self._dir_buffer = None
+
+	@contextmanager
+	def transaction(self):
+		yield
+		table = self._table
+		if self._removed_bytes > COMPACT_MIN_BYTES and self._removed_bytes > len(table.names) * COMPACT_RATIO:
+			self._compact()
+
+	def _compact(self):
+		logging.debug("compacting %d bytes of removed names" % (self._removed_bytes,))
+		table = self._table
+		compacted = FileTable()
+		for file_id in xrange(len(table)):
+			dir_id = table.dirs[file_id]
+			if dir_id >= 0:
+				compacted.append(dir_id, table.name(file_id))
+		# searches already running carry on with the old table
+		self._table = compacted
+		self._removed_bytes = 0
+
+	def _dir_id(self, path):
+		dir_id = self._dir_ids.get(path)
+		if dir_id is None:
+			dir_id = len(self._dir_paths)
+			self._dir_paths.append(path)
+			self._dir_ids[path] = dir_id
+			self._dirs_version += 1
+		return dir_id
+
+	def _files_in(self, dir_id):
+		"""name -> file id, for each file in a directory"""
+		table = self._table
+		return dict((table.name(file_id), file_id) for file_id in table.dir_files.get(dir_id, ()))
+
+	def _find(self, dir_id, name):
+		"""the id of the file called `name` in a directory, or None"""
+		if dir_id is None: return None
+		table = self._table
+		names = table.names
+		starts = table.starts
+		name = to_bytes(name) + SEPARATOR
+		length = len(name)
+		# (compared in place, rather than decoding every name)
+		for file_id in table.dir_files.get(dir_id, ()):
+			start = starts[file_id]
+			if names[start:start + length] == name:
+				return file_id
+		return None
+
+	def _remove(self, file_id):
+		table = self._table
+		table.dir_files[table.dirs[file_id]].remove(file_id)
+		table.dirs[file_id] = -1
+		self._removed_bytes += table.end(file_id) - table.starts[file_id]
+
+	def add_files(self, files):
+		by_dir = {}
+		for path, name in files:
+			by_dir.setdefault(path, set()).add(to_bytes(name))
+		added = 0
+		for path, names in by_dir.iteritems():
+			dir_id = self._dir_id(path)
+			if len(names) == 1:
+				names = [name for name in names if self._find(dir_id, name) is None]
+			else:
+				names = names.difference(self._files_in(dir_id))
+			for name in names:
+				self._table.append(dir_id, name)
+				added += 1
+		return added
+
+	def remove_file(self, path):
+		path, name = split_path(path)
+		file_id = self._find(self._dir_ids.get(path), name)
+		if file_id is None: return 0
+		self._remove(file_id)
+		return -1
+
+	def _subtree(self, path):
+		"""(path, id) of every directory at or beneath `path`"""
+		# (only directories that have held files are stored, so `path` itself may not be)
+		return [(subdir_path, dir_id) for subdir_path, dir_id in self._dir_ids.iteritems()
+			if subdir_path.startswith(path)]
+
+	def remove_dir(self, path):
+		subtree = self._subtree(dir_path(path))
+		if not subtree: return 0
+		table = self._table
+		removed = 0
+		for subdir_path, dir_id in subtree:
+			for file_id in table.dir_files.pop(dir_id, ()):
+				table.dirs[file_id] = -1
+				self._removed_bytes += table.end(file_id) - table.starts[file_id]
+				removed += 1
+			del self._dir_ids[subdir_path]
+			self._dir_paths[dir_id] = None
+		self._dirs_version += 1
+		return -removed
+
+	def move_file(self, src, dest):
+		src_dir, src_name = split_path(src)
+		dest_dir, dest_name = split_path(dest)
+		src_dir_id = self._dir_ids.get(src_dir)
+		file_id = self._find(src_dir_id, src_name)
+		if file_id is None:
+			return self.add_files([(dest_dir, dest_name)])
+		dest_dir_id = self._dir_id(dest_dir)
+		# a move can replace an existing file
+		replaced = self._find(dest_dir_id, dest_name)
+		removed = 0
+		if replaced is not None and replaced != file_id:
+			self._remove(replaced)
+			removed = -1
+		table = self._table
+		if dest_name == src_name:
+			table.dir_files[src_dir_id].remove(file_id)
+			table.dir_files.setdefault(dest_dir_id, array.array('i')).append(file_id)
+			table.dirs[file_id] = dest_dir_id
+		else:
+			self._remove(file_id)
+			table.append(dest_dir_id, to_bytes(dest_name))
+		return removed
+
+	def move_dir(self, src, dest):
+		src = dir_path(src)
+		dest = dir_path(dest)
+		subtree = self._subtree(src)
+		if not subtree: return None
+		if src == dest: return 0
+		# a move can replace an existing (empty) directory
+		removed = self.remove_dir(dest)
+		for subdir_path, dir_id in subtree:
+			del self._dir_ids[subdir_path]
+		for subdir_path, dir_id in subtree:
+			new_path = dest + subdir_path[len(src):]
+			self._dir_ids[new_path] = dir_id
+			self._dir_paths[dir_id] = new_path
+		self._dirs_version += 1
+		return removed
+
+	def update_dir(self, path, mtime, names, rules=None):
+		dir_id = self._dir_id(dir_path(path))
+		names = set(map(to_bytes, names))
+		existing = self._files_in(dir_id)
+		added = 0
+		for name, file_id in existing.iteritems():
+			if name not in names:
+				self._remove(file_id)
+				added -= 1
+		# (the walker has already filtered the listing)
+		for name in names.difference(existing):
+			self._table.append(dir_id, name)
+			added += 1
+		return added
+
+	def candidates(self, query, interrupted, interruption):
+		"""
+		Name queries are a single scan of the names. For path queries, each
+		directory matches some number of leading fragments (as many as it can),
+		and its files are the ones whose names match all the rest.
+		"""
+		scorer = Scorer(query)
+		table = self._table
+		count = len(table)
+		dir_paths = self._dir_paths
+		if not scorer.match_path:
+			pattern = _pattern(scorer.fragments, scorer.anchor_start, scorer.anchor_end)
+			file_ids = self._scan(table, count, pattern, interrupted, interruption)
+		else:
+			file_ids = self._path_candidates(scorer, table, count, interrupted, interruption)
+		for file_id in file_ids:
+			dir_id = table.dirs[file_id]
+			path = dir_paths[dir_id] if dir_id >= 0 else None
+			if path is not None:
+				name = adapt_str(table.name(file_id))
+				yield name, path + name
+
+	def _scan(self, table, count, pattern, interrupted, interruption):
+		"""ids of the files (among the first `count`) whose names contain a match for `pattern`"""
+		if not count: return
+		lower = table.lower
+		starts = table.starts
+		end = table.end(count - 1)
+		position = 0
+		while position < end:
+			if interrupted():
+				interruption.append(True)
+				return
+			chunk_end = min(end, position + SCAN_CHUNK)
+			if chunk_end < end:
+				# (whole names only)
+				chunk_end = lower.index(SEPARATOR, chunk_end) + 1
+			while True:
+				match = pattern.search(lower, position, chunk_end)
+				# (an empty pattern matches at the very end, too)
+				if match is None or match.start() >= chunk_end: break
+				file_id = bisect.bisect_right(starts, match.start(), 0, count) - 1
+				# on to the next name
+				position = lower.index(SEPARATOR, match.start()) + 1
+				if table.dirs[file_id] >= 0:
+					yield file_id
+			position = chunk_end
+
+	def _dir_matches(self, scorer):
+		"""
+		How many leading fragments of a path query each directory's path
+		matches (or -1 if it can't be the start of a match), by dir id.
+		"""
+		version = self._dirs_version
+		if self._dir_buffer is None or self._dir_buffer[0] != version:
+			paths = list(self._dir_paths)
+			buffer = bytearray(''.join(to_bytes(path or '').lower() + SEPARATOR for path in paths))
+			starts = array.array('I')
+			position = 0
+			for path in paths:
+				starts.append(position)
+				position += len(to_bytes(path or '')) + 1
+			self._dir_buffer = (version, buffer, starts)
+		version, buffer, starts = self._dir_buffer
+		# (with an anchored start, the path must start with the first
+		# fragment, unless the file is in the root)
+		matched = array.array('b', [-1 if scorer.anchor_start else 0]) * len(starts)
+		if scorer.anchor_start:
+			root_id = self._dir_ids.get(u'')
+			if root_id is not None and root_id < len(matched):
+				matched[root_id] = 0
+		for n in range(1, len(scorer.fragments) + 1):
+			pattern = _pattern(scorer.fragments[:n], anchor_start=scorer.anchor_start)
+			position = 0
+			while True:
+				match = pattern.search(buffer, position)
+				if match is None: break
+				dir_id = bisect.bisect_right(starts, match.start()) - 1
+				matched[dir_id] = n
+				position = buffer.index(SEPARATOR, match.start()) + 1
+		return matched
+
+	def _path_candidates(self, scorer, table, count, interrupted, interruption):
+		fragments = scorer.fragments
+		matched = self._dir_matches(scorer)
+		def remaining(n):
+			# (with an anchored end, the last fragment must be in the name)
+			return min(n, len(fragments) - 1) if scorer.anchor_end else n
+		groups = {}
+		for dir_id, n in enumerate(matched):
+			if n >= 0 and dir_id in table.dir_files:
+				groups.setdefault(remaining(n), []).append(dir_id)
+		for n, dir_ids in sorted(groups.items()):
+			if interrupted():
+				interruption.append(True)
+				return
+			if n == len(fragments):
+				# the directory matched everything
+				for dir_id in dir_ids:
+					for file_id in table.dir_files.get(dir_id, ()):
+						if file_id < count:
+							yield file_id
+				continue
+			pattern = _pattern(fragments[n:], anchor_start=scorer.anchor_start and n == 0, anchor_end=scorer.anchor_end)
+			if sum(len(table.dir_files.get(dir_id, ())) for dir_id in dir_ids) * 4 < count:
+				# few enough files to check one at a time
+				for dir_id in dir_ids:
+					for file_id in table.dir_files.get(dir_id, ()):
+						if file_id < count and pattern.search(table.lower, table.starts[file_id], table.end(file_id)):
+							yield file_id
+			else:
+				for file_id in self._scan(table, count, pattern, interrupted, interruption):
+					dir_id = table.dirs[file_id]
+					# (directories created since the search began can wait for the next one)
+					if 0 <= dir_id < len(matched) and remaining(matched[dir_id]) == n:
+						yield file_id
@@ -0,0 +1,94 @@
+import os
+
+def adapt_str(s):
+	return s.decode("iso-8859-1")
+
+def to_unicode(s):
+	return s if isinstance(s, unicode) else adapt_str(s)
+
+def dir_path(path):
+	"""directories are stored relative to the root, with a trailing separator ('' for the root itself)"""
+	path = to_unicode(path).rstrip(os.path.sep)
+	return path + os.path.sep if path else u''
+
+def split_path(path):
+	base, name = os.path.split(to_unicode(path))
+	return dir_path(base), name
+
+class NullTransaction(object):
+	def __enter__(self): return self
+	def __exit__(self, *exc_info): pass
+
+class Backend(object):
+	"""
+	Storage for the index. The DB calls the mutators (which return how many
+	files they added, as a negative number for removals) from its writer
+	thread, and `candidates` from its search thread.
+	"""
+	# whether the index can be kept between runs (at an index_path)
+	persistent = False
+	# whether the backend needs somewhere on disk to put a non-persistent index
+	needs_scratch_dir = False
+
+	def __init__(self, index_path=None, scratch_dir=None):
+		pass
+
+	@classmethod
+	def open_existing(cls, index_path):
+		"""
+		(persistent backends) a backend that only searches the index at
+		`index_path`, as it is, from the calling thread - or None if there's
+		no index there that it can read without rebuilding
+		"""
+		return None
+
+	def open(self):
+		"""(writer thread) start writing, returning how many files are already indexed"""
+		return 0
+
+	def open_reader(self):
+		"""(search thread) start reading"""
+		pass
+
+	def transaction(self):
+		"""a context manager around each batch of changes"""
+		return NullTransaction()
+
+	def add_files(self, files):
+		"""add (directory path, name) pairs, skipping files that are already present"""
+		raise NotImplementedError()
+
+	def remove_file(self, path):
+		raise NotImplementedError()
+
+	def remove_dir(self, path):
+		raise NotImplementedError()
+
+	def move_file(self, src, dest):
+		raise NotImplementedError()
+
+	def move_dir(self, src, dest):
+		"""returns None (and does nothing) if `src` isn't in the index"""
+		raise NotImplementedError()
+
+	def update_dir(self, path, mtime, names, rules=None):
+		"""
+		bring the direct children of `path` in line with a fresh listing,
+		made at `mtime` under ignore files with the checksum `rules`
+		"""
+		raise NotImplementedError()
+
+	def candidates(self, query, interrupted, interruption):
+		"""
+		(name, path) rows including every file matching `query`. Stops
+		early (appending to `interruption`) once `interrupted()` is true.
+		"""
+		raise NotImplementedError()
+
+	def load_dirs(self):
+		"""the (path -> (mtime, rules)) of every directory in a persistent index"""
+		return {}
+
+	def close(self):
+		"""(search thread) stop reading"""
+		pass
@@ -1,22 +1,22 @@
 #!/usr/bin/env python
 import curses
 import os
-import sys
-import subprocess
 from curses import ascii
 from time import sleep
 import threading
 from Queue import Queue, Empty
 
-from file_finder import FileFinder
-from highlight import Highlight
+from highlight import segments
 from log import QueueHandler, log_exceptions
 from search import Search
+from stats import STATS, STARTUP, status_line
 
 import logging
 
 MAX_RESULTS = 50
 MIN_QUERY = 2
+# at most one frame is drawn per this many seconds
+FRAME_INTERVAL = 1.0 / 30
 END = object()
 START = object()
 PREVIOUS = -1
@@ -38,8 +38,18 @@ class CursesUI(object):
 		self.status = ""
 		self.ui_lock = threading.Lock()
 		self.status_queue = Queue()
-		self._num_files = 0
 		self.query = None
+		self.show_stats = bool(options.stats_path)
+		self.stats_line = ""
+		# set (and notified) when something needs drawing
+		self._frame = threading.Condition()
+		self._needs_frame = False
+		# what's on screen, to only redraw what has changed
+		self._drawn = {}
+		self._drawn_rows = []
+		# the thread handling a batch of keys, which sends one search at the end of it
+		self._batching_thread = None
+		self._batched_search = None
 
 	def run(self):
 		rootLogger = logging.getLogger()
@@ -47,8 +57,11 @@ class CursesUI(object):
 		logging.info("scanning ...")
 		def _doit():
 			try:
-				self.finder = FileFinder(self.opt.base_path, path_filter=self.opt.path_filter, quit_indicator=QUITTING_TIME)
+				self.finder = self.opt.finder(QUITTING_TIME)
+				STARTUP.mark('finder')
+				# (only starts the indexing, which carries on in the background)
 				self.finder.populate()
+				STARTUP.mark('index started')
 				curses.wrapper(self._run)
 			finally:
 				QUITTING_TIME.set()
@@ -69,11 +82,34 @@ class CursesUI(object):
 	@log_exceptions
 	def results_loop(self):
 		while True:
-			search = self.finder.results()
+			searches = [self.finder.results()]
+			# (everything that's arrived only needs to be drawn once)
+			try:
+				while True:
+					searches.append(self.finder.results(blocking=False))
+			except Empty: pass
+			self.ui_lock.acquire()
+			for search in searches:
+				self.set_results(search)
+			self.ui_lock.release()
+			self.request_frame()
+
+	def request_frame(self):
+		with self._frame:
+			self._needs_frame = True
+			self._frame.notify()
+
+	@log_exceptions
+	def render_loop(self):
+		while True:
+			with self._frame:
+				while not self._needs_frame:
+					self._frame.wait()
+				self._needs_frame = False
 			self.ui_lock.acquire()
-			self.set_results(search)
 			self.update()
 			self.ui_lock.release()
+			sleep(FRAME_INTERVAL)
 	
 	@log_exceptions
 	def status_loop(self):
@@ -81,29 +117,19 @@ class CursesUI(object):
 		def _stat(msg):
 			self.ui_lock.acquire()
 			self.status = msg
-			self.update()
 			self.ui_lock.release()
+			self.request_frame()
 		while True:
 			try:
 				status_msg = self.status_queue.get(timeout=1.2)
 				_stat(status_msg)
 				sleep(1)
 			except Empty: pass
+			if self.show_stats:
+				self.stats_line = status_line(self.finder.stats())
 			if self.status_queue.empty():
-				num_files = self.update_files_indexed()
-				_stat("%s files indexed" % (num_files,))
-	
-	def update_files_indexed(self):
-		new_num_files = self.finder.file_count
-		if self._num_files != new_num_files:
-			self.requery_if_doing_nothing()
-		self._num_files = new_num_files
-		return new_num_files
-
-	def requery_if_doing_nothing(self):
-		if not self.finder.has_pending_queries:
-			logging.debug("resubmitting query: %s" % (self.query,))
-			self.set_query(self.query, is_repeat = True)
+				# (the index refreshes the results itself as files change)
+				_stat("%s files indexed" % (self.finder.file_count,))
 
 	@log_exceptions
 	def _run(self, mainscr):
@@ -111,15 +137,20 @@ class CursesUI(object):
 		self._init_colors()
 		self._init_screens()
 		self._init_input()
+		STARTUP.mark('curses')
 		self.update()
+		STARTUP.mark('first frame')
 
 		display_thread = threading.Thread(target=self.results_loop, name="[curses] results handler")
 		status_thread = threading.Thread(target=self.status_loop, name="[curses] status updater")
+		render_thread = threading.Thread(target=self.render_loop, name="[curses] renderer")
 		display_thread.daemon = True
 		status_thread.daemon = True
+		render_thread.daemon = True
 
 		display_thread.start()
 		status_thread.start()
+		render_thread.start()
 
 		self._input_loop()
 		import time
@@ -156,7 +187,9 @@ class CursesUI(object):
 		self.win_height, self.win_width = self.mainscr.getmaxyx()
 		self.input_win = curses.newwin(1, self.win_width, 0, 0)
 		self.results_win = curses.newpad(MAX_RESULTS, self.win_width)
-		self.status_win = curses.newwin(1, self.win_width, self.win_height-1, 0)
+		# (the stats get a line of their own, above the status)
+		self.status_height = 2 if self.show_stats else 1
+		self.status_win = curses.newwin(self.status_height, self.win_width, self.win_height-self.status_height, 0)
 
 		#IMPORTANT: input_win *must* be the last, so that it gets redrawed
 		#           last (and therefore gets the cursor)
@@ -164,6 +197,10 @@ class CursesUI(object):
 	
 	def resize(self):
 		self._init_screens()
+		# (what was drawn at the old size needs clearing from the whole screen)
+		self.input_win.clearok(True)
+		self._drawn = {}
+		self._drawn_rows = []
 
 	def _init_input(self):
 		curses.raw()
@@ -178,12 +215,21 @@ class CursesUI(object):
 			logging.debug("resizing...")
 			self.resize()
 		self.draw_input()
-		self.draw_results()
+		with STATS.timer('draw'):
+			self.draw_results()
 		self.draw_status()
 		self._redraw()
+
+	def _changed(self, part, state):
+		"""whether `part` needs drawing, as it was last drawn in a different state"""
+		if self._drawn.get(part) == state:
+			return False
+		self._drawn[part] = state
+		return True
 	
 	def draw_input(self):
-		self.input_win.clear()
+		if not self._changed('input', (self.query, self.input_position)): return
+		self.input_win.erase()
 		find_text = "Find: "
 
 		self.input_win.addnstr(0,0, find_text, self.win_width, A_PROMPT)
@@ -193,40 +239,53 @@ class CursesUI(object):
 		self.input_win.move(0,self.input_position + len(find_text))
 		
 	def draw_results(self):
-		#TODO: scroll results buffer
-		linepos = 0
+		"""draw the rows that differ from what's on screen"""
+		rows = [(file, path, linepos == self.selected, spans)
+			for linepos, (file, path, spans) in enumerate(self.results[:MAX_RESULTS])]
+		if not rows and len(self.query) >= MIN_QUERY and not self.finder.has_pending_queries:
+			rows = [None]
+		drawn_rows = self._drawn_rows
+		for linepos in range(max(len(rows), len(drawn_rows))):
+			row = rows[linepos] if linepos < len(rows) else False
+			if linepos < len(drawn_rows) and drawn_rows[linepos] == row: continue
+			self.results_win.move(linepos, 0)
+			self.results_win.clrtoeol()
+			if row is not False:
+				self.draw_result(linepos, row)
+		self._drawn_rows = rows
+
+	def draw_result(self, linepos, row):
 		indent_width = 6
+		if row is None:
+			self.results_win.insnstr(linepos, indent_width, 'No Matches...', self.win_width - indent_width, A_ERR)
+			return
+		file, path, selected, spans = row
 		filename_len = min(int(self.win_width / 1.5), 50)
 		path_len = self.win_width - filename_len - 1 - indent_width
-
-		self.results_win.clear()
-		for file, path in self.results:
-			attr_mod = curses.A_REVERSE if linepos == self.selected else curses.A_NORMAL
-			drawn_chars = 0
-			remaining_chars = filename_len
-			for highlighted, segment in self.highlight(file):
-				attrs = A_FILENAME | A_HIGHLIGHT if highlighted else A_FILENAME
-				self.results_win.insnstr(linepos, indent_width + drawn_chars, segment, remaining_chars, attrs | attr_mod)
-				drawn_chars += len(segment)
-				remaining_chars -= len(segment)
-				if remaining_chars <= 0:
-					break
-			
-			# now draw the path
-			relpath = os.path.split(path)[0]
-			explanation = ''
-			if relpath:
-				explanation = "(in %s)" % (relpath,)
-			self.results_win.insnstr(linepos, indent_width + filename_len + 1, explanation, path_len, A_PATH)
-			linepos += 1
-			if linepos >= MAX_RESULTS:
+		attr_mod = curses.A_REVERSE if selected else curses.A_NORMAL
+		drawn_chars = 0
+		remaining_chars = filename_len
+		for highlighted, segment in segments(file, spans, offset=len(path) - len(file)):
+			attrs = A_FILENAME | A_HIGHLIGHT if highlighted else A_FILENAME
+			self.results_win.insnstr(linepos, indent_width + drawn_chars, segment, remaining_chars, attrs | attr_mod)
+			drawn_chars += len(segment)
+			remaining_chars -= len(segment)
+			if remaining_chars <= 0:
 				break
-		if linepos == 0 and len(self.query) >= MIN_QUERY and not self.finder.has_pending_queries:
-			self.results_win.insnstr(linepos, indent_width, 'No Matches...', self.win_width - indent_width, A_ERR)
+		
+		# now draw the path
+		relpath = os.path.split(path)[0]
+		explanation = ''
+		if relpath:
+			explanation = "(in %s)" % (relpath,)
+		self.results_win.insnstr(linepos, indent_width + filename_len + 1, explanation, path_len, A_PATH)
 	
 	def draw_status(self):
-		self.status_win.clear()
-		self.status_win.insnstr(0, 0, self.status, self.win_width, A_STATUS)
+		if not self._changed('status', (self.stats_line, self.status)): return
+		self.status_win.erase()
+		if self.show_stats:
+			self.status_win.insnstr(0, 0, self.stats_line, self.win_width, A_STATUS)
+		self.status_win.insnstr(self.status_height-1, 0, self.status, self.win_width, A_STATUS)
 	
 	def with_selected(self, func):
 		index = self.selected
@@ -234,7 +293,7 @@ class CursesUI(object):
 			logging.warning("no such index: %s" % (index,))
 			self.clear_status()
 			return
-		filepath = self.results[index][-1]
+		filepath = self.results[index][1]
 		func(filepath)
 		
 	def open_selected(self):
@@ -256,7 +315,10 @@ class CursesUI(object):
 		self.ui_lock.release()
 	
 	def set_query(self, new_query, is_repeat = False):
-		if len(new_query) >= MIN_QUERY:
+		if self._batching_thread is threading.current_thread():
+			# (sent once the whole batch of keys is handled)
+			self._batched_search = (new_query, is_repeat)
+		elif len(new_query) >= MIN_QUERY:
 			self.finder.find(Search(new_query, is_repeat=is_repeat))
 		else:
 			self.finder.find(None)
@@ -267,8 +329,8 @@ class CursesUI(object):
 		self.ui_lock.release()
 	
 	def set_results(self, search):
-		self.highlight = Highlight(search.text)
-		self.results = list(search.results)
+		# (name, path, the matched parts of the path)
+		self.results = [(name, path, spans) for (name, path), spans in zip(search.results, search.spans)]
 		if search.is_repeat:
 			self.selected = min(self.selected, len(self.results)-1)
 		else:
@@ -319,7 +381,7 @@ class CursesUI(object):
 			if scr is self.results_win:
 				scr.noutrefresh(
 					self.results_scroll, 0, 1, 0,
-					self.win_height-2, self.win_width)
+					self.win_height-1-self.status_height, self.win_width)
 			else:
 				scr.noutrefresh()
 		curses.doupdate()
@@ -335,10 +397,41 @@ class CursesUI(object):
 				logging.exception("error copying to clipboard")
 		self.with_selected(action)
 
+	def dump_stats(self):
+		if not self.show_stats:
+			self.flash("stats are off (see --stats)")
+			return
+		self.flash(" ** stats saved to %s **" % (self.finder.dump_stats(),))
+
 	
 	def _input_iteration(self):
-		ch = self.mainscr.getch()
+		keys = [self.mainscr.getch()]
+		# handle every key that's already waiting (a paste, or typing over
+		# a slow link) before searching or drawing
+		self.mainscr.nodelay(True)
+		try:
+			while True:
+				ch = self.mainscr.getch()
+				if ch == -1: break
+				keys.append(ch)
+		finally:
+			self.mainscr.nodelay(False)
 		if QUITTING_TIME.isSet(): return False
+		self._batching_thread = threading.current_thread()
+		try:
+			for ch in keys:
+				if not self._handle_key(ch):
+					return False
+		finally:
+			self._batching_thread = None
+		if self._batched_search is not None:
+			new_query, is_repeat = self._batched_search
+			self._batched_search = None
+			self.set_query(new_query, is_repeat)
+		self.request_frame()
+		return True
+
+	def _handle_key(self, ch):
 		logging.debug("input: %r (%s / %s, ctrl=%s)" % (ch, ascii.unctrl(ch), ascii.ctrl(ch), ascii.isctrl(ch)))
 		if ascii.isprint(ch):
 			self.add_char(chr(ch))
@@ -361,6 +454,8 @@ class CursesUI(object):
 		elif ascii.isctrl(ch) and ascii.ctrl(ch) in (ascii.STX, ascii.ETX, ascii.CAN, ascii.ETX): # ctrl-c, variously o_O
 			logging.debug("copy to clipboard")
 			self.copy_selected_path_to_clipboard()
+		elif ch == ascii.DC4: # ctrl-T
+			self.dump_stats()
 		elif ch == ascii.ESC:
 			self.set_query("")
 		elif ch == ascii.EOT: # ctrl-D
@@ -368,9 +463,6 @@ class CursesUI(object):
 			return False
 		else:
 			logging.debug("not handled...")
-		self.ui_lock.acquire()
-		self.update()
-		self.ui_lock.release()
 		return True
 
 
@@ -0,0 +1,386 @@
+import os
+import time
+import json
+import errno
+import fcntl
+import shutil
+import socket
+import logging
+import tempfile
+import threading
+import Queue as queue
+from log import log_exceptions
+from search import Search, EMPTY_RESULTS
+from db import DEFAULT_BACKEND
+from backend import to_unicode
+from stats import STATS, STARTUP
+import stats
+
+# a daemon with no clients for this many seconds exits
+IDLE_TIMEOUT = 30 * 60
+# how often the daemon checks whether it's been idle too long
+IDLE_CHECK_INTERVAL = 5.0
+# how long a client waits for a daemon it started to start listening
+START_TIMEOUT = 5.0
+CONNECT_INTERVAL = 0.05
+# how often clients are told about a changed file count
+COUNT_INTERVAL = 0.5
+
+# The protocol is a JSON object per line. Clients send
+#   {"find": text, "is_repeat": bool} (with empty text when there's nothing to find) and {"stats": true}
+# and the daemon sends
+#   {"text": text, "is_repeat": bool, "final": bool, "sent": time, "results": [[name, path], ...],
+#    "spans": [[[start, end], ...], ...]} (the matched parts of each result's path),
+#   {"file_count": n} and {"stats": snapshot}
+# (text goes over as latin-1, the same way it goes into the index)
+
+def socket_dir():
+	"""somewhere only this user can reach the daemons"""
+	path = os.environ.get('XDG_RUNTIME_DIR')
+	if path:
+		return path
+	path = os.path.join(tempfile.gettempdir(), 'file-finder-%d' % (os.getuid(),))
+	try:
+		os.mkdir(path, 0700)
+	except OSError, e:
+		if e.errno != errno.EEXIST: raise
+	if os.stat(path).st_uid != os.getuid():
+		raise RuntimeError("%s belongs to someone else" % (path,))
+	return path
+
+class Connection(object):
+	"""one end of a daemon connection, sending and receiving messages"""
+	def __init__(self, sock):
+		self.sock = sock
+		self._lock = threading.Lock()
+
+	def send(self, message):
+		"""send a message, returning whether it could be"""
+		try:
+			with self._lock:
+				self.sock.sendall(json.dumps(message) + '\n')
+			return True
+		except socket.error, e:
+			logging.debug("can't send to daemon connection: %s" % (e,))
+			return False
+
+	def messages(self):
+		"""every message received, until the other end goes away"""
+		try:
+			for line in self.sock.makefile('r'):
+				yield json.loads(line)
+		except socket.error, e:
+			logging.debug("daemon connection lost: %s" % (e,))
+
+	def close(self):
+		try:
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except socket.error: pass
+		self.sock.close()
+
+def start_thread(target, name, *args):
+	thread = threading.Thread(target=log_exceptions(target), args=args, name=name)
+	thread.daemon = True
+	thread.start()
+	return thread
+
+class Daemon(object):
+	"""
+	Owns the index of some Roots, and serves searches of it over a unix
+	socket to any number of clients. Started (in the background) by the
+	first client that can't connect, it exits once it has had no clients
+	for IDLE_TIMEOUT.
+	"""
+	def __init__(self, socket_path, roots, path_filter, index_path=None, scan_threads=None,
+			backend=DEFAULT_BACKEND, seed_from_git=False, log_path=None):
+		self.socket_path = socket_path
+		# (absolute, as the daemon runs from the root directory)
+		self.roots = roots
+		self.path_filter = path_filter
+		self.index_path = index_path
+		self.backend = backend
+		self.scan_threads = scan_threads
+		self.seed_from_git = seed_from_git
+		self.log_path = log_path or os.path.splitext(socket_path)[0] + '.log'
+		self.clients = set()
+		self._clients_lock = threading.Lock()
+		self._idle_since = time.time()
+		self.db = None
+
+	def start(self):
+		"""run the daemon in a new, detached process"""
+		pid = os.fork()
+		if pid:
+			os.waitpid(pid, 0)
+			return
+		# (the first child only exists to orphan the second, so that it
+		# isn't left as a zombie or tied to this session)
+		try:
+			os.setsid()
+			if os.fork() == 0:
+				self._detach()
+				log_exceptions(self.serve)()
+		finally:
+			os._exit(0)
+
+	def _detach(self):
+		os.chdir('/')
+		devnull = os.open(os.devnull, os.O_RDWR)
+		for fd in (0, 1, 2):
+			os.dup2(devnull, fd)
+		root = logging.getLogger()
+		for handler in list(root.handlers):
+			root.removeHandler(handler)
+		handler = logging.FileHandler(self.log_path, mode='w')
+		handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+		root.addHandler(handler)
+
+	def serve(self):
+		# (imported here, as clients don't need them)
+		from watcher import TreeWatcher, DEFAULT_SCAN_THREADS
+		from db import DB, backend_class
+		# only one daemon may serve a socket; a client that raced
+		# another to start one will connect to the winner
+		lock = open(self.socket_path + '.lock', 'w')
+		try:
+			fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except IOError:
+			logging.info("a daemon is already serving %s" % (self.socket_path,))
+			return
+		if os.path.exists(self.socket_path):
+			# left behind by a daemon that died
+			os.remove(self.socket_path)
+		server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		server.bind(self.socket_path)
+		server.listen(16)
+		logging.info("serving %s on %s" % (self.roots, self.socket_path))
+		scratch_dir = None
+		if self.index_path is None and backend_class(self.backend).needs_scratch_dir:
+			scratch_dir = tempfile.mkdtemp(prefix='file-finder-')
+		try:
+			self.db = DB(
+					event_queue=queue.Queue(maxsize=50),
+					search_queue=queue.Queue(),
+					results_queue=queue.Queue(),
+					path_filter=self.path_filter,
+					index_path=self.index_path,
+					scratch_dir=scratch_dir,
+					backend=self.backend)
+			watcher = TreeWatcher(self.roots, self.db.event_queue, self.path_filter,
+					known_dirs=self.db.load_dirs(), threads=self.scan_threads or DEFAULT_SCAN_THREADS,
+					seed_from_git=self.seed_from_git)
+			self.db.rescan = watcher.rescan
+			start_thread(watcher.run_forever, "[daemon] watcher")
+			start_thread(self._send_results, "[daemon] results")
+			start_thread(self._send_file_counts, "[daemon] file counts")
+			self._accept(server)
+		finally:
+			os.remove(self.socket_path)
+			server.close()
+			if scratch_dir is not None:
+				shutil.rmtree(scratch_dir, ignore_errors=True)
+			logging.info("daemon for %s is finished" % (self.roots,))
+
+	def _accept(self, server):
+		server.settimeout(IDLE_CHECK_INTERVAL)
+		while True:
+			try:
+				sock, address = server.accept()
+			except socket.timeout:
+				with self._clients_lock:
+					idle = not self.clients and time.time() - self._idle_since > IDLE_TIMEOUT
+				if idle:
+					logging.info("no clients for %ss, exiting" % (IDLE_TIMEOUT,))
+					return
+				continue
+			sock.settimeout(None)
+			start_thread(self._serve_client, "[daemon] client", Connection(sock))
+
+	def _serve_client(self, client):
+		with self._clients_lock:
+			self.clients.add(client)
+		logging.debug("client connected (%d now)" % (len(self.clients),))
+		client.send({'file_count': self.db.file_count})
+		try:
+			for message in client.messages():
+				if 'find' in message:
+					text = message['find'].encode('iso-8859-1')
+					self.db.search_queue.put(Search(text, is_repeat=message.get('is_repeat', False), origin=client))
+				elif 'stats' in message:
+					STATS.depth('event_queue', self.db.event_queue.qsize())
+					STATS.depth('dbqueue', self.db.dbqueue.qsize())
+					client.send({'stats': STATS.snapshot()})
+		finally:
+			with self._clients_lock:
+				self.clients.discard(client)
+				if not self.clients:
+					self._idle_since = time.time()
+			self.db.forget(client)
+			client.close()
+			logging.debug("client disconnected")
+
+	def _send_results(self):
+		while True:
+			search = self.db.results_queue.get()
+			search.origin.send({
+				'text': to_unicode(search.text),
+				'is_repeat': search.is_repeat,
+				'final': search.final,
+				'sent': search.sent,
+				'results': [(to_unicode(name), to_unicode(path)) for name, path in search.results],
+				'spans': search.spans,
+			})
+
+	def _send_file_counts(self):
+		sent = self.db.file_count
+		while True:
+			time.sleep(COUNT_INTERVAL)
+			file_count = self.db.file_count
+			if file_count == sent:
+				continue
+			with self._clients_lock:
+				clients = list(self.clients)
+			for client in clients:
+				client.send({'file_count': file_count})
+			sent = file_count
+
+class RemoteFileFinder(object):
+	"""
+	A FileFinder that searches an index kept by a Daemon, starting
+	the daemon if there isn't one yet.
+	"""
+	def __init__(self, daemon, quit_indicator, stats_path=None):
+		self.daemon = daemon
+		self.quit_indicator = quit_indicator
+		self.results_queue = queue.Queue()
+		self.stats_path = stats_path
+		self.connection = None
+		# the newest search made before there was a connection to send it on
+		self._unsent = None
+		self._connection_lock = threading.Lock()
+		self._file_count = 0
+		self._index_stats = {}
+		# the text of the newest search, until its results arrive
+		self._pending = None
+
+	def attach(self):
+		"""connect to the daemon only if it's already running, returning whether it was"""
+		sock = self._connect()
+		if sock is not None:
+			self._attached(sock)
+		return sock is not None
+
+	def populate(self):
+		"""
+		Connect to the daemon, starting it if need be. A new daemon is
+		connected to in the background, with searches made meanwhile
+		sent once it's listening.
+		"""
+		sock = self._connect()
+		if sock is None:
+			logging.info("starting a daemon for %s" % (self.daemon.roots,))
+			self.daemon.start()
+			start_thread(self._attach_when_started, "[daemon client] connector")
+		else:
+			self._attached(sock)
+		if self.stats_path:
+			import atexit
+			atexit.register(self.dump_stats)
+
+	def _attach_when_started(self):
+		sock = None
+		deadline = time.time() + START_TIMEOUT
+		while sock is None and time.time() < deadline:
+			time.sleep(CONNECT_INTERVAL)
+			sock = self._connect()
+		if sock is None:
+			logging.error("the daemon didn't start; see %s" % (self.daemon.log_path,))
+			if self._pending is not None:
+				# (no answer is coming)
+				self._pending = None
+				self.results_queue.put(EMPTY_RESULTS)
+			return
+		self._attached(sock)
+
+	def _attached(self, sock):
+		with self._connection_lock:
+			self.connection = Connection(sock)
+			start_thread(self._receive, "[daemon client] receiver")
+			STARTUP.mark('attached')
+			if self._unsent is not None:
+				self._send_search(self._unsent)
+				self._unsent = None
+
+	def _connect(self):
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			sock.connect(self.daemon.socket_path)
+			return sock
+		except socket.error, e:
+			if e.errno not in (errno.ENOENT, errno.ECONNREFUSED): raise
+			sock.close()
+			return None
+
+	def _receive(self):
+		for message in self.connection.messages():
+			if 'results' in message:
+				search = Search(message['text'].encode('iso-8859-1'), is_repeat=message['is_repeat'])
+				search.results = [tuple(row) for row in message['results']]
+				search.spans = [[tuple(span) for span in spans] for spans in message['spans']]
+				search.final = message['final']
+				search.sent = message['sent']
+				if search.text == self._pending:
+					self._pending = None
+				self.results_queue.put(search)
+			elif 'file_count' in message:
+				self._file_count = message['file_count']
+			elif 'stats' in message:
+				self._index_stats = message['stats']
+		if not self.quit_indicator.is_set():
+			logging.error("lost the connection to the daemon")
+		if self._pending is not None:
+			# (no answer is coming)
+			self._pending = None
+			self.results_queue.put(EMPTY_RESULTS)
+
+	@property
+	def has_pending_queries(self):
+		return self._pending is not None
+
+	def find(self, search):
+		if not search:
+			self._pending = None
+			self.results_queue.put(EMPTY_RESULTS)
+		else:
+			self._pending = search.text
+		with self._connection_lock:
+			if self.connection is None:
+				self._unsent = search or None
+			else:
+				self._send_search(search)
+
+	def _send_search(self, search):
+		if not search:
+			self.connection.send({'find': u''})
+		else:
+			self.connection.send({'find': to_unicode(search.text), 'is_repeat': search.is_repeat})
+
+	def results(self, blocking=True):
+		search = self.results_queue.get(block=blocking)
+		if search.sent is not None:
+			STATS.record('results', time.time() - search.sent)
+		return search
+
+	@property
+	def file_count(self):
+		return self._file_count
+
+	def stats(self):
+		"""the daemon's latest stats (as of the last call) and this process's"""
+		if self.connection is not None:
+			self.connection.send({'stats': True})
+		return stats.merge(self._index_stats, STATS.snapshot())
+
+	def dump_stats(self):
+		stats.dump(self.stats(), self.stats_path)
+		return self.stats_path
@@ -1,16 +1,119 @@
+import time
 import threading
 import logging
 import Queue as queue
-import sqlite3
+from collections import OrderedDict
 from log import log_exceptions
 from search import Search
+from score import Scorer, top_matches
+from stats import STATS
+from backend import dir_path, split_path, to_unicode
 
-def adapt_str(s):
-	return s.decode("iso-8859-1")
-sqlite3.register_adapter(str, adapt_str)
+def _sqlite_backend():
+	from sqlite_backend import SqliteBackend
+	return SqliteBackend
+
+def _array_backend():
+	from array_backend import ArrayBackend
+	return ArrayBackend
+
+# how to get each backend's class (imported only when it's used, which
+# keeps sqlite3 out of processes that never touch the index)
+BACKENDS = {
+	'sqlite': _sqlite_backend,
+	'array': _array_backend,
+}
+DEFAULT_BACKEND = 'sqlite'
+
+def backend_class(name):
+	return BACKENDS[name]()
+
+MAX_RESULTS = 51
+# time (in seconds) to spend on a query before showing the best results so far
+SEARCH_BUDGET = 1.0 / 30
+# a search still running after this long returns the best results so far
+SEARCH_TIMEOUT = 2.0
+# queries matching at most this many files keep their full
+# match list around, to be refined in memory as the user types
+CANDIDATE_LIMIT = 2000
+QUERY_CACHE_SIZE = 32
+
+# file events are applied in batches of (roughly) this many files,
+# unless the first event in a batch has waited this long (in seconds)
+EVENT_BATCH_SIZE = 5000
+EVENT_BATCH_LATENCY = 0.2
+# shown results are brought up to date with the index at most this often (in seconds)
+REFRESH_INTERVAL = 0.25
+
+class Changes(object):
+	"""
+	What some batches of file events did to the index, in enough
+	detail to tell whether (and how) a search's results changed
+	"""
+	def __init__(self):
+		# (directory path, name) of each file that may be new
+		self.added = []
+		# paths of removed files
+		self.removed = set()
+		# directory path -> the names of its files (any others were removed)
+		self.listed = {}
+		# paths of removed directories, whose files all went with them
+		self.removed_dirs = []
+		# whether files were added that aren't in `added` (those of a moved directory)
+		self.unknown_added = False
+
+	def __nonzero__(self):
+		return bool(self.added or self.removed or self.listed or self.removed_dirs or self.unknown_added)
+
+	def update(self, other):
+		self.added.extend(other.added)
+		self.removed.update(other.removed)
+		for path, names in other.listed.items():
+			# (a file missing from either listing may have been removed)
+			self.listed[path] = self.listed[path] & names if path in self.listed else names
+		self.removed_dirs.extend(other.removed_dirs)
+		self.unknown_added = self.unknown_added or other.unknown_added
+
+	def removes(self, path):
+		"""whether the file at `path` may have been removed"""
+		if path in self.removed:
+			return True
+		base, name = split_path(path)
+		names = self.listed.get(base)
+		if names is not None and name not in names:
+			return True
+		return any(path.startswith(removed_dir) for removed_dir in self.removed_dirs)
+
+	def refresh(self, scorer, results):
+		"""
+		How a complete search's `results` are affected: (whether they
+		changed, the new results or None if they need searching for)
+		"""
+		if self.unknown_added:
+			return True, None
+		kept = [row for row in results if not self.removes(row[1])]
+		if len(kept) < len(results) and len(results) >= MAX_RESULTS:
+			# (the next best, which weren't shown, belong in their place)
+			return True, None
+		paths = set(path for name, path in kept)
+		added = False
+		for base, name in self.added:
+			name = to_unicode(name)
+			path = base + name
+			if path in paths or scorer(name, path) is None: continue
+			if self.removes(path):
+				# (added and removed again, in some order)
+				return True, None
+			kept.append((name, path))
+			paths.add(path)
+			added = True
+		if not added and len(kept) == len(results):
+			return False, results
+		return True, top_matches(scorer, kept, MAX_RESULTS)[0]
 
 class DB(object):
-	def __init__(self, event_queue, search_queue, results_queue, path_filter, file_count=None):
+	def __init__(self, event_queue, search_queue, results_queue, path_filter, file_count=None,
+			index_path=None, scratch_dir=None, backend=DEFAULT_BACKEND):
 		if file_count is None:
 			# it's not that important...
 			class ObjectWithValue(object):
@@ -22,7 +125,21 @@ class DB(object):
 		self.search_queue = search_queue
 		self.path_filter = path_filter
 		self.results_queue = results_queue
+		self.backend = backend_class(backend)(index_path=index_path, scratch_dir=scratch_dir)
+		# bumped after every committed batch of changes
+		self.generation = 0
+		self._query_cache = OrderedDict()
+		# the most recent search received from each origin; anything older is abandoned
+		self._newest_searches = {}
+		# the search whose results each origin was sent last
+		self._shown = {}
+		# what has changed since the shown results were refreshed
+		self._changes = Changes()
+		self._changes_lock = threading.Lock()
+		self._changed = threading.Event()
 		self.dblock = threading.Lock()
+		# walks a directory (by its path in the index) again, if set
+		self.rescan = None
 
 		self.dbqueue = queue.Queue(maxsize=1)
 
@@ -30,7 +147,7 @@ class DB(object):
 		search_thread.daemon = True
 		search_thread.start()
 
-		file_thread = threading.Thread(target=log_exceptions(self.poll_events), name="[db] file event handler")
+		file_thread = threading.Thread(target=log_exceptions(self.poll_events), name="[db] writer")
 		file_thread.daemon = True
 		file_thread.start()
 
@@ -38,113 +155,275 @@ class DB(object):
 		db_thread.daemon = True
 		db_thread.start()
 
+		refresh_thread = threading.Thread(target=log_exceptions(self.poll_changes), name="[db] refresher")
+		refresh_thread.daemon = True
+		refresh_thread.start()
+
 	@property
 	def file_count(self):
 		return self._file_count.value
 	def _add_file_count(self, n):
 		self._file_count.value += n
 
-	# poll_events and poll_search each look at their respective queues.
-	# When they have something, they add their desired action to the
-	# single-size db queue. This causes the db thread to execute the action.
+	# poll_events writes to the backend, applying file events as they
+	# arrive. poll_search hands the latest search to the single-size db
+	# queue, where the db thread reads from the backend. poll_changes
+	# has the db thread refresh the shown results after changes.
 	def poll_events(self):
+		self._add_file_count(self.backend.open())
 		while True:
-			event = self.event_queue.get()
-			self.dbqueue.put(lambda event=event: self.process_event(event))
+			self.process_events(self._next_event_batch())
+
+	def _next_event_batch(self):
+		event = self.event_queue.get()
+		STATS.depth('event_queue', self.event_queue.qsize())
+		batch = [event]
+		size = event.size
+		deadline = time.time() + EVENT_BATCH_LATENCY
+		while size < EVENT_BATCH_SIZE:
+			timeout = deadline - time.time()
+			if timeout <= 0: break
+			try:
+				event = self.event_queue.get(timeout=timeout)
+			except queue.Empty: break
+			batch.append(event)
+			size += event.size
+		return batch
 	
 	def poll_search(self):
 		while True:
-			search = self.search_queue.get()
+			searches = [self.search_queue.get()]
 			# empty the queue; old queries are useless
 			try:
 				while True:
-					search = self.search_queue.get_nowait()
+					searches.append(self.search_queue.get_nowait())
 			except queue.Empty: pass
-			self.dbqueue.put(lambda search=search: self._perform(search))
+			newest = OrderedDict()
+			for search in searches:
+				newest[search.origin] = search
+			for search in newest.values():
+				self._newest_searches[search.origin] = search
+				if not search:
+					# (the origin has nothing to search for, so nothing to refresh)
+					self._shown.pop(search.origin, None)
+					continue
+				self.dbqueue.put(lambda search=search: self._perform(search))
+
+	def forget(self, origin):
+		"""abandon any search from an origin that's gone away"""
+		self._newest_searches.pop(origin, None)
+		self._shown.pop(origin, None)
+
+	def poll_changes(self):
+		while True:
+			self._changed.wait()
+			self._changed.clear()
+			self.dbqueue.put(self._refresh)
+			time.sleep(REFRESH_INTERVAL)
+
+	def _refresh(self):
+		"""
+		Bring the results each origin was shown up to date with the
+		changes since, patching them where the changes say how, and
+		searching again where they don't.
+		"""
+		with self._changes_lock:
+			changes, self._changes = self._changes, Changes()
+		for origin, shown in self._shown.items():
+			newest = self._newest_searches.get(origin)
+			if newest is None or newest.text != shown.text:
+				# (a newer search is on its way, and will see the changes)
+				continue
+			changed, results = True, None
+			if shown.final:
+				changed, results = changes.refresh(Scorer(shown.text), shown.results)
+			if not changed:
+				continue
+			if results is None:
+				STATS.count('refreshes.searched')
+				self._perform(Search(shown.text, is_repeat=True, origin=origin), current=newest)
+			else:
+				STATS.count('refreshes.patched')
+				refreshed = Search(shown.text, is_repeat=True, origin=origin)
+				refreshed.results = results
+				self._send(refreshed)
 
-	def _perform(self, search):
-		search.results = self.find(search.text)
+	def _perform(self, search, current=None):
+		"""run `search`, until `current` (the search itself, by default) is superseded"""
+		if current is None:
+			current = search
+		superseded = lambda: current is not self._newest_searches.get(search.origin)
+		STATS.count('searches')
+		if superseded():
+			STATS.count('searches.superseded')
+			return
+		with STATS.timer('query'):
+			search.results, complete = self.find(search.text, budget=SEARCH_BUDGET, cancelled=superseded)
+		if superseded():
+			STATS.count('searches.superseded')
+			return
+		# (an empty partial result is not worth showing)
+		shown = complete or bool(search.results)
+		search.final = complete
+		if shown:
+			self._send(search)
+		if not complete:
+			# show the best of what we got through in time, then finish the job
+			STATS.count('searches.continued')
+			repeat = Search(search.text, is_repeat=shown, origin=search.origin)
+			with STATS.timer('query'):
+				repeat.results, complete = self.find(search.text, budget=SEARCH_TIMEOUT, cancelled=superseded)
+			if superseded():
+				STATS.count('searches.superseded')
+				return
+			self._send(repeat)
+
+	def _send(self, search):
+		# (only the shown results need their matched parts working out)
+		scorer = Scorer(search.text)
+		search.spans = [scorer.spans(name, path) for name, path in search.results]
+		search.sent = time.time()
+		self._shown[search.origin] = search
 		self.results_queue.put(search)
 
 	def poll_db(self):
-		self._create_db()
+		self.backend.open_reader()
 		while True:
 			try:
 				self.dbqueue.get()()
 			except StopIteration: break
 	
-	def process_event(self, event):
-		if not self.path_filter.should_include(event.path): return
-		if event.exists:
+	def process_events(self, events):
+		"""
+		Apply a batch of file events in a single transaction,
+		inserting runs of added files in bulk.
+		"""
+		added = []
+		changes = Changes()
+		STATS.count('events', len(events))
+		with STATS.timer('insert'), self.backend.transaction():
+			for event in events:
+				if not self._wanted(event): continue
+				if event.is_seed:
+					base = dir_path(event.base)
+					added.extend((base, name) for name in event.names)
+				elif event.exists and not event.is_dir and not event.is_move:
+					added.append((dir_path(event.base), event.name))
+				else:
+					self._add_file_count(self.backend.add_files(added))
+					changes.added.extend(added)
+					added = []
+					self.process_event(event, changes)
+			self._add_file_count(self.backend.add_files(added))
+			changes.added.extend(added)
+		# only once the changes are visible to readers
+		self.generation += 1
+		if changes:
+			with self._changes_lock:
+				self._changes.update(changes)
+			self._changed.set()
+
+	def _wanted(self, event):
+		# (removing what's now excluded is always fine - it may have been indexed under older rules)
+		return not event.exists or self.path_filter.should_include(event.path, is_file=not event.is_dir)
+
+	def process_event(self, event, changes=None):
+		"""apply a single event, noting what it did in `changes`"""
+		if not self._wanted(event): return
+		if changes is None:
+			changes = Changes()
+		backend = self.backend
+		if event.names is not None:
+			added = backend.update_dir(event.path, event.mtime, event.names, event.rules)
+			base = dir_path(event.path)
+			changes.listed[base] = set(map(to_unicode, event.names))
+			changes.added.extend((base, name) for name in event.names)
+		elif event.is_move:
+			if event.is_dir:
+				added = backend.move_dir(event.path, event.dest_path)
+				if added is None:
+					# (never indexed - moved before the walk got to it, say)
+					added = 0
+					if self.rescan is not None:
+						self.rescan(event.dest_path)
+				changes.removed_dirs.append(dir_path(event.path))
+				changes.unknown_added = True
+			else:
+				added = backend.move_file(event.path, event.dest_path)
+				changes.removed.add(to_unicode(event.path))
+				changes.added.append(split_path(event.dest_path))
+		elif event.exists:
 			if event.is_dir: return
-			self.add_file(event.path, event.name)
+			added = backend.add_files([(dir_path(event.base), event.name)])
+			changes.added.append((dir_path(event.base), event.name))
 		else:
 			if event.is_dir:
-				self.remove_dir(event.path)
+				added = backend.remove_dir(event.path)
+				changes.removed_dirs.append(dir_path(event.path))
 			else:
-				self.remove_file(event.path)
-
-	def execute(self, query, params=(), return_count=False):
-		try:
-			cursor = self.db.cursor()
-			if params:
-				result = cursor.execute(query, params)
-				return cursor.rowcount if return_count else result
-			else:
-				return cursor.execute(query)
-		finally:
-			self.db.commit()
+				added = backend.remove_file(event.path)
+				changes.removed.add(to_unicode(event.path))
+		self._add_file_count(added)
 
-	def find(self, query):
+	def find(self, query, budget=None, cancelled=None):
+		"""
+		The best MAX_RESULTS matches for `query`, and whether every match was
+		considered before `budget` seconds ran out (or `cancelled()` became true).
+		"""
 		logging.debug("searching: %r" % (query))
-		if '/' in query:
-			query_type = 'path'
-			query = query.replace('/', ' ')
-		else:
-			query_type = 'name'
+		generation = self.generation
+		for cached_query, (cached_generation, matches, results) in self._query_cache.items():
+			if cached_generation != generation:
+				del self._query_cache[cached_query]
+		if query in self._query_cache:
+			return self._query_cache[query][2], True
 
-		query_param = self._format_like_statement(query)
+		deadline = None if budget is None else time.time() + budget
+		def interrupted():
+			return ((deadline is not None and time.time() > deadline) or
+				(cancelled is not None and cancelled()))
 
-		sql = ("SELECT DISTINCT name, path FROM files " +
-		      "WHERE %s LIKE ? escape '\\' ORDER BY length(path), name LIMIT 51" % (query_type,))
-		logging.debug("%s :: %s" % (sql, query_param))
-		res = self.execute(sql, (query_param,))
-		return list(res)
-	
-	def _format_like_statement(self, query):
-		# psuedo-regexp anchoring
-		prefix = '' if query.startswith('^') else '%'
-		suffix = '' if query.endswith('$')   else '%'
-
-		query = query.rstrip('$').lstrip('^')
-		query = query.replace('_', '\\_')
-		query = query.replace('%', '\\%')
-		wildcarded_query = query.replace(" ", "%")
-		query_param = "%s%s%s" % (prefix, wildcarded_query, suffix)
-
-		return query_param
-
-	def _create_db(self):
-		self.db = sqlite3.connect(":memory:")
-		self.db.execute("CREATE TABLE files ( id AUTO_INCREMENT PRIMARY KEY, " +
-			"path VARCHAR(255), name VARCHAR(255))")
-	
-	def close(self):
-		def action():
-			self.db.close()
-			raise StopIteration()
-		self.dbqueue.put(action)
+		candidates = self._cached_candidates(query)
+		interruption = []
+		if candidates is None:
+			candidates = self.backend.candidates(query, interrupted, interruption)
+		results, matches, complete = top_matches(Scorer(query), candidates, MAX_RESULTS,
+			keep=CANDIDATE_LIMIT, interrupted=interrupted)
+		complete = complete and not interruption
+		if complete and matches is not None:
+			self._cache_matches(query, generation, matches, results)
+		return results, complete
+
+	def _cached_candidates(self, query):
+		"""
+		The cached matches of the longest shorter query that `query` refines
+		(or None), which must include every match for `query`.
+		"""
+		refined = [cached_query for cached_query in self._query_cache if self._refines(query, cached_query)]
+		if not refined:
+			return None
+		previous_query = max(refined, key=len)
+		logging.debug("refining %r from %r" % (query, previous_query))
+		return self._query_cache[previous_query][1]
 
-	def add_file(self, path, name):
-		self._add_file_count(1)
-		self.execute("INSERT INTO files (name, path) VALUES (?, ?)",
-			(name, path))
+	def _refines(self, query, previous_query):
+		# any query with extra characters on the end can only match
+		# a subset of what the shorter one did
+		return (query.startswith(previous_query)
+			and not previous_query.endswith('$')
+			and ('/' in query) == ('/' in previous_query))
 
-	def remove_file(self, path):
-		self._add_file_count(-1)
-		self.execute("DELETE FROM files where path = ?", (path, ))
+	def _cache_matches(self, query, generation, matches, results):
+		self._query_cache.pop(query, None)
+		self._query_cache[query] = (generation, matches, results)
+		while len(self._query_cache) > QUERY_CACHE_SIZE:
+			self._query_cache.popitem(last=False)
 
-	def remove_dir(self, path):
-		files_deleted = self.execute("DELETE FROM files WHERE path like ?", (path+"%", ), return_count=True)
-		self._add_file_count(-files_deleted)
+	def load_dirs(self):
+		return self.backend.load_dirs()
 
+	def close(self):
+		def action():
+			self.backend.close()
+			raise StopIteration()
+		self.dbqueue.put(action)
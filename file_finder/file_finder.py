@@ -1,44 +1,110 @@
 import os
-import subprocess
+import time
+import atexit
+import shutil
+import tempfile
 import logging
-from Queue import Queue
+from Queue import Queue, Empty
+from threading import Thread
 from log import log_exceptions
 from multiprocessing import Queue as MPQueue
 from multiprocessing import Process, Value
-from watcher import TreeWatcher
-from search import Search
-from db import DB
+from search import Search, EMPTY_RESULTS
+from db import DEFAULT_BACKEND
+from stats import STATS, REPORT_INTERVAL
+from result_ring import ResultRing
+import stats
 
-EMPTY_RESULTS = Search('')
-EMPTY_RESULTS.results = []
+# how often the indexing process checks that its finder is still there
+PARENT_CHECK_INTERVAL = 1
 
 class FileFinder(object):
-	def __init__(self, basepath, path_filter, quit_indicator):
+	def __init__(self, roots, path_filter, quit_indicator, index_path=None, scan_threads=None, stats_path=None,
+			backend=DEFAULT_BACKEND, seed_from_git=False):
 		self.quit_indicator = quit_indicator
 		self.event_queue = Queue(maxsize=50)
 		self.search_queue = MPQueue()
-		self.results_queue = MPQueue()
-		if not basepath.endswith(os.path.sep):
-			basepath = basepath + os.path.sep
-		self.basepath = basepath
+		self.results_queue = ResultRing()
+		self.roots = roots
 		self.path_filter = path_filter
+		self.index_path = index_path
+		self.backend = backend
+		self.scratch_dir = None
+		if index_path is None:
+			# (made whether or not the backend needs one, so that it
+			# only has to be imported by the indexing process)
+			self.scratch_dir = tempfile.mkdtemp(prefix='file-finder-')
+		self.scan_threads = scan_threads
+		self.seed_from_git = seed_from_git
 		self._file_count = Value('i', 0)
+		# with a stats_path, the indexing process reports its stats
+		# on the stats queue, and they're all saved there at exit
+		self.stats_path = stats_path
+		self.stats_queue = MPQueue() if stats_path else None
+		self._index_stats = {}
 	
 	def populate(self):
+		self._parent_pid = os.getpid()
 		ioproc = Process(target=self._poll, args=(self,))
 		ioproc.daemon = True
 		ioproc.start()
+		# the indexing process is killed rather than shut down, so its
+		# scratch index is cleaned up from here (or by _exit_with_parent,
+		# if this process dies without running atexit handlers)
+		atexit.register(self._cleanup, ioproc)
+		if self.stats_path:
+			# (runs before the cleanup)
+			atexit.register(self.dump_stats)
+
+	def _cleanup(self, ioproc):
+		if ioproc.is_alive():
+			ioproc.terminate()
+			ioproc.join()
+		if self.scratch_dir is not None:
+			shutil.rmtree(self.scratch_dir, ignore_errors=True)
 	
+	def _exit_with_parent(self):
+		"""(indexing process) clean up and go, should the finder die without killing us"""
+		while os.getppid() == self._parent_pid:
+			time.sleep(PARENT_CHECK_INTERVAL)
+		logging.info("the finder has gone, so its index is going too")
+		if self.scratch_dir is not None:
+			shutil.rmtree(self.scratch_dir, ignore_errors=True)
+		os._exit(0)
+
 	@log_exceptions
 	def _poll(self, *a):
+		watch = Thread(target=log_exceptions(self._exit_with_parent), name="[index] parent watch")
+		watch.daemon = True
+		watch.start()
+		# (imported here, so that the UI can start without them)
+		from watcher import TreeWatcher, DEFAULT_SCAN_THREADS
+		from db import DB
 		db = DB(
 				event_queue=self.event_queue,
 				search_queue=self.search_queue,
 				results_queue=self.results_queue,
 				path_filter=self.path_filter,
-				file_count = self._file_count)
-		watcher = TreeWatcher(self.basepath, self.event_queue, self.path_filter.exclude_paths)
+				file_count = self._file_count,
+				index_path=self.index_path,
+				scratch_dir=self.scratch_dir,
+				backend=self.backend)
+		watcher = TreeWatcher(self.roots, self.event_queue, self.path_filter,
+				known_dirs=db.load_dirs(), threads=self.scan_threads or DEFAULT_SCAN_THREADS,
+				seed_from_git=self.seed_from_git)
+		db.rescan = watcher.rescan
+		if self.stats_queue is not None:
+			reporter = Thread(target=log_exceptions(self._report_stats), args=(db,), name="[stats] reporter")
+			reporter.daemon = True
+			reporter.start()
 		watcher.run_forever()
+
+	def _report_stats(self, db):
+		while True:
+			time.sleep(REPORT_INTERVAL)
+			STATS.depth('event_queue', self.event_queue.qsize())
+			STATS.depth('dbqueue', db.dbqueue.qsize())
+			self.stats_queue.put(STATS.snapshot())
 	
 	@property
 	def has_pending_queries(self):
@@ -47,16 +113,33 @@ class FileFinder(object):
 	def find(self, search):
 		if not search:
 			self.results_queue.put(EMPTY_RESULTS)
+			# (so the index stops refreshing the results of the last one)
+			self.search_queue.put(Search(''))
 		else:
 			self.search_queue.put(search)
 	
 	def results(self, blocking=True):
 		try:
-			return self.results_queue.get(block=blocking)
+			search = self.results_queue.get(block=blocking)
 		except EOFError: # only happens on shutdown
 			return EMPTY_RESULTS
+		if search.sent is not None:
+			STATS.record('results', time.time() - search.sent)
+		return search
 	
 	@property
 	def file_count(self):
 		return self._file_count.value
 
+	def stats(self):
+		"""the latest stats of both the indexing process and this one"""
+		if self.stats_queue is not None:
+			try:
+				while True:
+					self._index_stats = self.stats_queue.get_nowait()
+			except (Empty, EOFError): pass
+		return stats.merge(self._index_stats, STATS.snapshot())
+
+	def dump_stats(self):
+		stats.dump(self.stats(), self.stats_path)
+		return self.stats_path
@@ -0,0 +1,102 @@
+"""
+Reads the paths of the files tracked by git straight from its index file
+(.git/index), without running git. Handles index versions 2, 3 and 4, as
+described in git's Documentation/technical/index-format.txt
+"""
+import os
+import struct
+
+HEADER = struct.Struct('>4sII')
+# ctime, mtime (seconds and nanoseconds), dev, ino, mode, uid, gid, size, sha1, flags
+ENTRY = struct.Struct('>10I20sH')
+EXTENDED_FLAGS = struct.Struct('>H')
+
+FLAG_EXTENDED = 0x4000
+FLAG_STAGE = 0x3000
+EXTENDED_SKIP_WORKTREE = 0x4000
+# the object type in the top bits of an entry's mode
+MODE_TYPE_SHIFT = 12
+FILE_TYPES = (0b1000, 0b1010) # regular files and symlinks (not submodules or sparse directories)
+
+class GitIndexError(Exception): pass
+
+def find_index(root):
+	"""
+	The index file of the checkout containing `root`, and the path of
+	`root` within that checkout (as a prefix), or (None, None).
+	"""
+	path = os.path.realpath(root)
+	prefix = ''
+	while True:
+		dotgit = os.path.join(path, '.git')
+		if os.path.isdir(dotgit):
+			return os.path.join(dotgit, 'index'), prefix
+		if os.path.isfile(dotgit):
+			# worktrees and submodules have a file pointing at their git dir
+			with open(dotgit) as f:
+				line = f.readline().strip()
+			if not line.startswith('gitdir:'):
+				return None, None
+			return os.path.join(path, line[len('gitdir:'):].strip(), 'index'), prefix
+		parent, name = os.path.split(path)
+		if parent == path:
+			return None, None
+		prefix = name + '/' + prefix
+		path = parent
+
+def _varint(data, offset):
+	"""git's variable-length offset encoding, returning (value, new offset)"""
+	byte = ord(data[offset])
+	offset += 1
+	value = byte & 0x7f
+	while byte & 0x80:
+		byte = ord(data[offset])
+		offset += 1
+		value = ((value + 1) << 7) | (byte & 0x7f)
+	return value, offset
+
+def tracked_files(index_path):
+	"""the path (relative to the top of the checkout) of each file in the index, in order"""
+	with open(index_path, 'rb') as f:
+		data = f.read()
+	if len(data) < HEADER.size:
+		raise GitIndexError("truncated index")
+	signature, version, count = HEADER.unpack_from(data)
+	if signature != 'DIRC':
+		raise GitIndexError("not a git index")
+	if version not in (2, 3, 4):
+		raise GitIndexError("unsupported index version %d" % (version,))
+
+	offset = HEADER.size
+	name = ''
+	previous = None
+	try:
+		for i in xrange(count):
+			start = offset
+			fields = ENTRY.unpack_from(data, offset)
+			mode, flags = fields[6], fields[11]
+			offset += ENTRY.size
+			extended = 0
+			if flags & FLAG_EXTENDED:
+				extended, = EXTENDED_FLAGS.unpack_from(data, offset)
+				offset += EXTENDED_FLAGS.size
+			if version == 4:
+				# each name drops some bytes from the end of the previous one, then adds its own
+				strip, offset = _varint(data, offset)
+				end = data.index('\0', offset)
+				name = name[:len(name) - strip] + data[offset:end]
+				offset = end + 1
+			else:
+				end = data.index('\0', offset)
+				name = data[offset:end]
+				# entries are padded with 1-8 NULs to a multiple of 8 bytes
+				offset = start + ((end - start + 8) & ~7)
+			if (mode >> MODE_TYPE_SHIFT) not in FILE_TYPES or extended & EXTENDED_SKIP_WORKTREE:
+				continue
+			# (a conflicted file has an entry for each stage)
+			if flags & FLAG_STAGE and name == previous:
+				continue
+			previous = name
+			yield name
+	except (struct.error, ValueError, IndexError), e:
+		raise GitIndexError("corrupt index: %s" % (e,))
@@ -1,16 +1,22 @@
 import optparse
 import logging
 import os
-import subprocess
+import sys
 import tempfile
 
 from path_filter import PathFilter
+from roots import Roots, RootsFilter
+from db import BACKENDS, DEFAULT_BACKEND, MAX_RESULTS, backend_class
+from query import FORMATS
+from stats import STARTUP
 
 ignore_path = os.path.expanduser(os.environ.get("FILE_FINDER_IGNORE", "~/.config/file-finder/ignore"))
+cache_path = os.path.expanduser(os.environ.get("FILE_FINDER_CACHE", "~/.cache/file-finder"))
 
 class Options(object):
 	def configure(self):
-		usage = "finder [base_path]"
+		STARTUP.mark('imports')
+		usage = "finder [options] [base_path ...]"
 		parser = optparse.OptionParser(usage)
 		parser.add_option('-o', '--open-cmd',
 			dest='open_cmd',
@@ -27,11 +33,52 @@ class Options(object):
 			help='basic mode (no curses UI)')
 		parser.add_option('-x', '--exclude', action='append',
 			default=[], help='add an exclude')
+		parser.add_option('-j', '--scan-threads', dest='scan_threads',
+			type='int', default=None,
+			help='number of threads used to scan the tree (4)')
+		parser.add_option('-c', '--cache', dest='cache',
+			action='store_true',
+			help='keep a persistent index in %s' % (cache_path,))
+		parser.add_option('--no-ignore-files', dest='ignore_files',
+			action='store_false', default=True,
+			help="index files that .gitignore (or .ignore) files exclude")
+		parser.add_option('-g', '--git', dest='git',
+			action='store_true',
+			help="in a git checkout, index the tracked files from git's index before walking the tree")
+		parser.add_option('-d', '--daemon', dest='daemon',
+			action='store_true',
+			help='search an index kept by a background daemon (started if need be), shared with other finders of the same tree')
+		parser.add_option('--backend', dest='backend',
+			choices=sorted(BACKENDS), default=DEFAULT_BACKEND,
+			help='how the index is stored: %s (%%default)' % (' or '.join(sorted(BACKENDS)),))
+		parser.add_option('--stats', dest='stats',
+			action='store_true',
+			help='show per-stage timings in the status bar, and save them as JSON at exit (or on ctrl+t)')
+		parser.add_option('--stats-file', dest='stats_file',
+			default=os.path.join(tempfile.gettempdir(), 'file-finder-stats.json'),
+			help='where to save stats (%default)')
+		parser.add_option('--startup-profile', dest='startup_profile',
+			action='store_true',
+			help='on exit, print how long each stage of starting up took, up to the first frame and beyond')
+
+		parser.add_option('-q', '--query', dest='query',
+			default=None,
+			help='print the best matches for QUERY and exit, using a running daemon or a cached index if there is one')
+		parser.add_option('--limit', dest='limit',
+			type='int', default=MAX_RESULTS,
+			help='print at most this many matches (%default, which is also the most an index will give)')
+		parser.add_option('--format', dest='format',
+			choices=FORMATS, default='lines',
+			help='how --query prints matches: %s (%%default)' % (', '.join(FORMATS),))
 
 		(options, args) = parser.parse_args()
+		STARTUP.mark('options')
 		self.verbose = options.verbose
 		self.log_level = logging.DEBUG if options.verbose else logging.INFO
-		if options.basic:
+		if options.query is not None:
+			# stdout is for results
+			logging.basicConfig(level=logging.DEBUG if options.verbose else logging.WARNING)
+		elif options.basic:
 			# logging to terminal is fine
 			logging.basicConfig(level=self.log_level)
 		else:
@@ -39,7 +86,6 @@ class Options(object):
 			logging.basicConfig(level=self.log_level, filename=os.path.join(tempfile.gettempdir(), 'file-finder.log'), filemode='w')
 			if not options.verbose:
 				# carelessly discard stdout and stderr
-				import sys
 				sys.stdout = sys.stderr = open(os.devnull, 'w')
 
 		self.open_cmd = options.open_cmd.split()
@@ -47,15 +93,63 @@ class Options(object):
 		self.path_filter = PathFilter()
 		map(self.path_filter.add_exclude, options.exclude)
 		self.load_user_excludes()
+		self.use_ignore_files = options.ignore_files
 		self.basic = options.basic
-		if len(args) == 1:
-			self.base_path = args[0]
-		elif len(args) == 0:
-			self.base_path = '.'
-		else:
-			parser.error("incorrect number of arguments")
+		self.scan_threads = options.scan_threads
+		# (absolute, as the daemon runs from elsewhere)
+		self.roots = Roots(args or ['.'])
+		if len(self.roots) > 1:
+			self.path_filter = RootsFilter(self.roots, self.path_filter, use_ignore_files=self.use_ignore_files)
+		elif self.use_ignore_files:
+			self.path_filter.use_ignore_files(self.roots.paths[0])
+		self.backend = options.backend
+		if options.cache and not backend_class(self.backend).persistent:
+			parser.error("the %s backend can't be cached" % (self.backend,))
+		self.index_path = self.cached_index_path() if options.cache else None
+		self.stats_path = options.stats_file if options.stats else None
+		self.daemon = options.daemon
+		self.seed_from_git = options.git
+		self.query = options.query
+		self.limit = options.limit
+		self.format = options.format
+		self.startup_profile = options.startup_profile
+		STARTUP.mark('configured')
 		return self
 	
+	def index_key(self):
+		import hashlib
+		# the index only contains what the filter let through, so
+		# each set of excludes gets its own
+		key = hashlib.sha1()
+		key.update("\0".join(map(os.path.realpath, self.roots.paths)))
+		for pattern in self.path_filter.exclude_paths + self.path_filter.include_files:
+			key.update("\0" + pattern)
+		if self.use_ignore_files:
+			key.update("\0ignore files")
+		return key.hexdigest()
+
+	def cached_index_path(self):
+		return os.path.join(cache_path, self.index_key() + '.sqlite')
+
+	def daemon_socket_path(self):
+		import hashlib
+		from daemon import socket_dir
+		# (socket paths are short, so the key is cut down)
+		key = hashlib.sha1("%s\0%s\0%s" % (self.index_key(), self.backend, self.index_path))
+		return os.path.join(socket_dir(), 'file-finder-%s.sock' % (key.hexdigest()[:16],))
+
+	def finder(self, quit_indicator):
+		if self.daemon:
+			from daemon import Daemon, RemoteFileFinder
+			daemon = Daemon(self.daemon_socket_path(), self.roots, path_filter=self.path_filter,
+				index_path=self.index_path, scan_threads=self.scan_threads, backend=self.backend,
+				seed_from_git=self.seed_from_git)
+			return RemoteFileFinder(daemon, quit_indicator=quit_indicator, stats_path=self.stats_path)
+		from file_finder import FileFinder
+		return FileFinder(self.roots, path_filter=self.path_filter, quit_indicator=quit_indicator,
+			index_path=self.index_path, scan_threads=self.scan_threads, stats_path=self.stats_path,
+			backend=self.backend, seed_from_git=self.seed_from_git)
+	
 	def load_user_excludes(self):
 		try:
 			with open(ignore_path) as ignore_file:
@@ -66,6 +160,14 @@ class Options(object):
 		except IOError: pass
 
 	def main(self):
+		if self.query is not None:
+			from query import run_query
+			status = run_query(self)
+			STARTUP.mark('results written')
+			self.print_startup_profile()
+			# (without waiting for the index's threads to notice the interpreter shutting down)
+			sys.stdout.flush()
+			os._exit(status)
 		if self.basic:
 			from repl import Repl
 			Repl(self).run()
@@ -76,13 +178,20 @@ class Options(object):
 			import threading
 			for t in threading.enumerate():
 				logging.debug("thread: %r is daemon? %r" % (t.name, t.daemon))
+		self.print_startup_profile()
+
+	def print_startup_profile(self):
+		if self.startup_profile:
+			# (stderr may have been redirected away from the UI)
+			print >> sys.__stderr__, STARTUP.report()
 	
 	def open(self, filepath):
 		logging.debug("opening file: %s" % (filepath,))
 		fullpath = self.full_path(filepath)
 		logging.debug("full command: %r" % (self.open_cmd + [fullpath],))
+		import subprocess
 		subprocess.Popen(self.open_cmd + [fullpath], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 	
 	def full_path(self, relpath):
-		return os.path.abspath(os.path.join(self.base_path, relpath))
+		return self.roots.absolute(relpath)
 
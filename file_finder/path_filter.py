@@ -1,5 +1,7 @@
 import re, os
+import zlib
 import logging
+import git_index
 
 DEFAULT_EXCLUDES = [
 	'.*',
@@ -8,10 +10,281 @@ DEFAULT_EXCLUDES = [
 	'*.egg-info',
 ]
 
+# per-directory files of .gitignore-style rules (later ones take precedence)
+IGNORE_FILES = ('.gitignore', '.ignore')
+# rules for the whole checkout (in its git dir), which its ignore files take precedence over
+EXCLUDE_FILE = os.path.join('info', 'exclude')
+# python 2's re supports at most 100 groups, so long rule files are compiled in chunks
+RULES_PER_REGEXP = 99
+
+def _glob_part_to_regexp(glob):
+	"""one path component of a gitignore pattern"""
+	regexp = []
+	i = 0
+	while i < len(glob):
+		char = glob[i]
+		i += 1
+		if char == '*':
+			regexp.append('[^/]*')
+		elif char == '?':
+			regexp.append('[^/]')
+		elif char == '\\' and i < len(glob):
+			regexp.append(re.escape(glob[i]))
+			i += 1
+		elif char == '[' and ']' in glob[i+1:]:
+			end = glob.index(']', i + 1)
+			chars = glob[i:end]
+			if chars.startswith('!'):
+				chars = '^' + chars[1:]
+			regexp.append('[%s]' % (chars.replace('\\', '\\\\'),))
+			i = end + 1
+		else:
+			regexp.append(re.escape(char))
+	return ''.join(regexp)
+
+def ignore_rule(line):
+	"""
+	A line from an ignore file as (regexp, negated, directories only, anchored),
+	or None. The regexp of an anchored rule matches paths relative to the
+	ignore file's directory, and the others match just the last component.
+	"""
+	line = line.rstrip('\r\n')
+	# trailing spaces don't count, unless they're escaped
+	stripped = line.rstrip(' ')
+	if stripped.endswith('\\') and len(stripped) < len(line):
+		stripped += ' '
+	line = stripped
+	if not line or line.startswith('#'):
+		return None
+	negated = line.startswith('!')
+	if negated or line.startswith('\\!') or line.startswith('\\#'):
+		line = line[1:]
+	dir_only = line.endswith('/')
+	line = line.rstrip('/')
+	if not line:
+		return None
+	# a pattern with a slash (other than at the end) is relative to its directory,
+	# one without matches at any depth
+	anchored = '/' in line
+	parts = line.lstrip('/').split('/')
+	regexp = []
+	for i, part in enumerate(parts):
+		last = i == len(parts) - 1
+		if part == '**':
+			regexp.append('.*' if last else '(?:.*/)?')
+		else:
+			regexp.append(_glob_part_to_regexp(part) + ('' if last else '/'))
+	return ''.join(regexp) + '$', negated, dir_only, anchored
+
+class IgnoreRules(object):
+	"""the rules from the ignore files in one directory"""
+	def __init__(self, rules):
+		self._negated = [negated for regexp, negated, dir_only, anchored in rules]
+		rules = list(enumerate(rules))
+		file_rules = [(i, rule) for i, rule in rules if not rule[2]]
+		# (name regexps, path regexps) for files and for directories
+		self._file_regexps = self._compile(file_rules)
+		self._dir_regexps = self._compile(rules)
+
+	def _compile(self, rules):
+		"""
+		Regexps of chunks of rules, with the rule number of each alternative.
+		They're in reverse order - as the last matching rule wins, the first
+		matching alternative is the one that counts.
+		"""
+		compiled = ([], [])
+		for anchored in (False, True):
+			numbered = [(i, rule[0]) for i, rule in reversed(rules) if rule[3] == anchored]
+			for start in range(0, len(numbered), RULES_PER_REGEXP):
+				chunk = numbered[start:start + RULES_PER_REGEXP]
+				regexp = re.compile('|'.join('(%s)' % (regexp,) for i, regexp in chunk))
+				compiled[anchored].append((regexp, [i for i, regexp_ in chunk]))
+		return compiled
+
+	def match(self, path, is_dir):
+		"""whether `path` is ignored (or None if no rule matches it)"""
+		name_regexps, path_regexps = self._dir_regexps if is_dir else self._file_regexps
+		winner = -1
+		for regexps, subject in ((name_regexps, path[path.rfind(os.path.sep) + 1:]), (path_regexps, path)):
+			for regexp, numbers in regexps:
+				match = regexp.match(subject)
+				if match is not None:
+					winner = max(winner, numbers[match.lastindex - 1])
+					break
+		if winner < 0:
+			return None
+		return not self._negated[winner]
+
+class IgnoreFiles(object):
+	"""
+	Applies the ignore files found throughout a tree, with git's semantics:
+	the deepest directory with a matching rule decides, and nothing inside
+	an ignored directory can be re-included. Each directory's rules are
+	read and compiled the first time a path under it is checked. When the
+	root is somewhere inside a git checkout, the rules of the directories
+	above it (up to the checkout's own) apply too.
+	"""
+	def __init__(self, root):
+		self.root = root
+		# directory -> IgnoreRules (or None where there are no ignore files)
+		self._rules = {}
+		# directory -> whether it is ignored
+		self._ignored_dirs = {}
+		# directory -> the rules that apply to its contents (see _ruled_dirs)
+		self._chains = {}
+		# the rules from outside the tree (see _outer_rules)
+		self._outer = None
+		# directory (or None, outside the tree) -> (path, mtime, size) of each of its ignore files
+		self._found = {}
+		# directory -> a checksum of the ignore files that apply to it (see stamp)
+		self._stamps = {}
+
+	def _read(self, paths, found):
+		rules = []
+		for path in paths:
+			try:
+				with open(path) as ignore_file:
+					stat = os.fstat(ignore_file.fileno())
+					found.append((path, stat.st_mtime, stat.st_size))
+					rules.extend(filter(None, map(ignore_rule, ignore_file)))
+			except IOError: pass
+		return IgnoreRules(rules) if rules else None
+
+	def _rules_for(self, directory):
+		try:
+			return self._rules[directory]
+		except KeyError: pass
+		found = self._found[directory] = []
+		rules = self._rules[directory] = self._read(
+			(os.path.join(self.root, directory, name) for name in IGNORE_FILES), found)
+		return rules
+
+	def stamp(self, directory):
+		"""
+		A checksum of every ignore file that applies to the contents of
+		`directory` (their paths, mtimes and sizes), which changes along
+		with any of them, so that a listing can be known to be out of date
+		"""
+		stamp = self._stamps.get(directory)
+		if stamp is None:
+			self._rules_for(directory)
+			if directory:
+				parent = os.path.dirname(directory.rstrip(os.path.sep))
+				stamp = self.stamp(parent + os.path.sep if parent else '')
+			else:
+				self._outer_rules()
+				stamp = zlib.crc32(repr(self._found[None]))
+			stamp = self._stamps[directory] = zlib.crc32(repr(self._found[directory]), stamp)
+		return stamp
+
+	def _outer_rules(self):
+		"""
+		(the root's path from there, IgnoreRules) for each directory above the
+		root up to its git checkout's, nearest first - the last of them
+		including the checkout's exclude file (even if the root is the checkout)
+		"""
+		if self._outer is not None:
+			return self._outer
+		self._outer = []
+		found = self._found[None] = []
+		index_path, prefix = git_index.find_index(self.root)
+		if index_path is None:
+			return self._outer
+		names = prefix.split('/')[:-1]
+		directory = os.path.realpath(self.root)
+		# (the root's own ignore files are read as any other directory's)
+		for depth in range(len(names) + 1):
+			paths = [os.path.join(directory, name) for name in IGNORE_FILES] if depth else []
+			if depth == len(names):
+				paths.insert(0, os.path.join(os.path.dirname(index_path), EXCLUDE_FILE))
+			rules = self._read(paths, found)
+			if rules is not None:
+				above = ''.join(name + os.path.sep for name in names[len(names) - depth:])
+				self._outer.append((above, rules))
+			directory = os.path.dirname(directory)
+		return self._outer
+
+	def is_ignored(self, path, is_dir=False):
+		path = path.rstrip(os.path.sep)
+		parent = path[:path.rfind(os.path.sep) + 1]
+		if parent and self._dir_ignored(parent):
+			return True
+		if is_dir:
+			return self._dir_ignored(path + os.path.sep) if path else False
+		return self._check(path, parent, False)
+
+	def _dir_ignored(self, directory):
+		ignored = self._ignored_dirs.get(directory)
+		if ignored is None:
+			path = directory[:-1]
+			parent = path[:path.rfind(os.path.sep) + 1]
+			ignored = bool(parent and self._dir_ignored(parent)) or self._check(path, parent, True)
+			self._ignored_dirs[directory] = ignored
+		return ignored
+
+	def _ruled_dirs(self, directory):
+		"""
+		(directory, path of the root from the rules' directory, IgnoreRules) for
+		`directory` and each one above it with rules, deepest first
+		"""
+		try:
+			return self._chains[directory]
+		except KeyError: pass
+		chain = []
+		rules = self._rules_for(directory)
+		if rules is not None:
+			chain.append((directory, '', rules))
+		if directory:
+			parent = os.path.dirname(directory.rstrip(os.path.sep))
+			chain.extend(self._ruled_dirs(parent + os.path.sep if parent else ''))
+		else:
+			chain.extend(('', above, rules) for above, rules in self._outer_rules())
+		self._chains[directory] = chain
+		return chain
+
+	def _check(self, path, parent, is_dir):
+		for base, above, rules in self._ruled_dirs(parent):
+			ignored = rules.match(above + path[len(base):], is_dir)
+			if ignored is not None:
+				return ignored
+		return False
+
+	def forget(self, directory):
+		"""(when an ignore file in `directory` has changed)"""
+		self._rules.pop(directory, None)
+		self._found.pop(directory, None)
+		self._chains.clear()
+		self._ignored_dirs.clear()
+		self._stamps.clear()
+
 class PathFilter(object):
+	"""
+	Decides which paths (relative to the root) get indexed.
+	All excludes (and includes) are combined into a single compiled
+	regex, shared by the tree walker (to skip whole directories before
+	they are listed) and the DB (for file events).
+	"""
 	def __init__(self):
-		self.set_excludes(DEFAULT_EXCLUDES)
 		self.include_files = []
+		self.set_excludes(DEFAULT_EXCLUDES)
+		self.ignore_files = None
+
+	def use_ignore_files(self, root):
+		"""also exclude whatever the .gitignore (and .ignore) files under root do"""
+		self.ignore_files = IgnoreFiles(root)
+
+	def rules_stamp(self, directory):
+		"""a checksum of the ignore files that apply to `directory`'s contents (None without them)"""
+		if self.ignore_files is None:
+			return None
+		return self.ignore_files.stamp(directory)
+
+	def ignore_files_changed(self, directory):
+		"""forget the rules of `directory`, returning whether they were in use"""
+		if self.ignore_files is None:
+			return False
+		self.ignore_files.forget(directory)
+		return True
 	
 	def glob_to_regexp(self, glob):
 		parts = glob.split("*")
@@ -20,43 +293,48 @@ class PathFilter(object):
 		regexp = "(^|%s)%s($|%s)" % (os.path.sep, '.*'.join(escaped_parts),os.path.sep)
 		logging.debug("converted %s -> %s" % (glob, regexp))
 		return regexp
-		return re.compile(regexp)
+
+	def _compile(self, regexps):
+		if not regexps:
+			return None
+		return re.compile('|'.join("(?:%s)" % (regexp,) for regexp in regexps))
+
+	def _update(self):
+		self._exclude_re = self._compile(self.exclude_paths)
+		self._include_re = self._compile(self.include_files)
 
 	def set_excludes(self, exclude_list):
 		self.exclude_paths = map(self.glob_to_regexp, exclude_list)
+		self._update()
 	
 	def add_exclude(self, exclude):
 		logging.debug("adding user exclude: %s" % (exclude,))
 		self.exclude_paths.append(self.glob_to_regexp(exclude))
+		self._update()
 	
 	def set_include_files(self, include_list):
 		self.include_files = map(self.glob_to_regexp, include_list)
+		self._update()
 	
 	def add_include(self, include):
 		self.include_files.append(self.glob_to_regexp(include))
+		self._update()
 	
 	def should_include(self, path, is_file=False):
-		for exclude_re in self.exclude_paths:
-			if re.search(exclude_re, path):
-				logging.debug("excluding %s as it matched: %s" % (path, exclude_re))
+		if self._exclude_re is not None:
+			match = self._exclude_re.search(path)
+			if match is not None:
+				logging.debug("excluding %s as it matched: %s" % (path, match.group(0)))
 				return False
-		if is_file and len(self.include_files) > 0:
-			file_name = os.path.basename(path)
-			for include_re in include_files:
-				if re.search(include_re, file_name):
-					return True
+		if self.ignore_files is not None and self.ignore_files.is_ignored(path, is_dir=not is_file):
 			return False
+		if is_file and self._include_re is not None:
+			return self._include_re.search(os.path.basename(path)) is not None
 		else:
 			return True
 	
 	def filter(self, dirnames, filenames):
 		"""modify dirnames and filenames in-place to remove
 		  all filtered paths"""
-		for dirname in dirnames[:]:
-			if not self.should_include(dirname, False):
-				dirnames.remove(dirname)
-
-		for filename in filenames[:]:
-			if not self.should_include(filename, True):
-				filenames.remove(filename)
-		
+		dirnames[:] = [dirname for dirname in dirnames if self.should_include(dirname, False)]
+		filenames[:] = [filename for filename in filenames if self.should_include(filename, True)]
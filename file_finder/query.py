@@ -0,0 +1,104 @@
+import os
+import sys
+import logging
+import threading
+from itertools import islice
+from search import Search
+from score import Scorer, top_matches
+from backend import to_unicode
+from db import backend_class
+
+FORMATS = ('lines', 'json', 'null')
+
+def daemon_results(finder, text):
+	logging.debug("querying the daemon on %s" % (finder.daemon.socket_path,))
+	finder.find(Search(text))
+	return final_results(finder.results)
+
+def index_results(opt, text):
+	"""results from the persistent index for this tree, or None if there isn't one"""
+	index_path = opt.cached_index_path()
+	# (only a reader: the index may belong to a finder that's running)
+	backend = backend_class(opt.backend).open_existing(index_path)
+	if backend is None:
+		return None
+	logging.debug("querying the index at %s" % (index_path,))
+	try:
+		results, matches, complete = top_matches(Scorer(text),
+			backend.candidates(text, lambda: False, []), opt.limit)
+	finally:
+		backend.close()
+	return results
+
+def final_results(next_search):
+	while True:
+		search = next_search()
+		if search.final:
+			return search.results
+
+def walk_results(opt, text):
+	"""the best matches from a walk of the tree (which has to finish before any are known)"""
+	logging.debug("no index, walking %s" % (opt.roots,))
+	results, matches, complete = top_matches(Scorer(text), walk_files(opt), opt.limit)
+	return results
+
+def walk_files(opt):
+	"""(name, path) of every file in the tree"""
+	path_filter = opt.path_filter
+	for prefix, root in opt.roots:
+		for base, dirnames, filenames in os.walk(root):
+			relpath = os.path.relpath(base, root)
+			relpath = prefix if relpath == os.curdir else prefix + relpath + os.path.sep
+			dirnames[:] = sorted(name for name in dirnames if path_filter.should_include(relpath + name + os.path.sep))
+			for name in sorted(filenames):
+				path = relpath + name
+				if path_filter.should_include(path, is_file=True):
+					yield name, path
+
+def write(rows, format, out):
+	"""write (name, path) rows as they come, returning how many there were"""
+	import json
+	count = 0
+	for name, path in rows:
+		if format == 'json':
+			out.write(json.dumps({'name': to_unicode(name), 'path': to_unicode(path)}) + '\n')
+		else:
+			# (paths are stored as latin-1, so this gets back their original bytes)
+			path = to_unicode(path).encode('iso-8859-1')
+			out.write(path + ('\0' if format == 'null' else '\n'))
+		out.flush()
+		count += 1
+	return count
+
+def run_query(opt, out=sys.stdout):
+	"""
+	Print the best matches for opt.query from the quickest source available:
+	a running daemon, then the persistent index, then a walk of the tree.
+	Returns an exit status like grep's (1 if nothing matched).
+	"""
+	text = opt.query
+	if not text:
+		return 1
+	from daemon import Daemon, RemoteFileFinder
+	daemon = Daemon(opt.daemon_socket_path(), opt.roots, path_filter=opt.path_filter,
+		index_path=opt.index_path, scan_threads=opt.scan_threads, backend=opt.backend,
+		seed_from_git=opt.seed_from_git)
+	finder = RemoteFileFinder(daemon, quit_indicator=threading.Event())
+	if finder.attach():
+		rows = daemon_results(finder, text)
+	else:
+		rows = index_results(opt, text)
+		if opt.daemon:
+			# (a new daemon's index starts out empty, so it's only any use to later queries)
+			finder.populate()
+	if rows is None:
+		rows = walk_results(opt, text)
+	if len(opt.roots) > 1:
+		# (the paths in the index are under directories that don't exist)
+		rows = ((name, opt.full_path(path)) for name, path in rows)
+	try:
+		count = write(islice(rows, opt.limit), opt.format, out)
+	except IOError:
+		# (the reader went away)
+		return 0
+	return 0 if count else 1
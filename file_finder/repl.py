@@ -6,9 +6,9 @@ import threading
 
 import logging
 
-from file_finder import FileFinder
-from highlight import Highlight
+from highlight import segments
 from search import Search
+from stats import STARTUP, status_line
 
 try:
 	import readline
@@ -32,26 +32,24 @@ class Repl(object):
 		self.found_files = []
 		self.opt = options
 	
-	def highlight_func(self, query_string):
-		if termstyle is None:
-			return lambda x: x
-		highlight = Highlight(query_string)
-		return lambda x: highlight.replace(x, green)
+	def highlight(self, filename, fullpath, spans):
+		highlighted = ''.join(green(segment) if matched else segment
+			for matched, segment in segments(filename, spans, offset=len(fullpath) - len(filename)))
+		# (padded to the width of the plain name)
+		return highlighted + ' ' * (30 - len(filename))
 			
-	def summarise(self, result_iter, query_string):
+	def summarise(self, search):
 		subprocess.call(['clear'])
 		self.found_files = []
 		i = 0
-		highlight = self.highlight_func(query_string)
-		for filename, fullpath in result_iter:
+		for (filename, fullpath), spans in zip(search.results, search.spans):
 			self.found_files.append(fullpath)
 			relpath = os.path.split(fullpath)[0]
 			explanation = ''
 			if relpath:
 				explanation = "(in %s)" % (relpath,)
 			index = str(i+1).rjust(2)
-			filename = filename.ljust(30)
-			print " %s%s   %s %s" % (yellow(index), yellow(":"), highlight(filename), black(explanation))
+			print " %s%s   %s %s" % (yellow(index), yellow(":"), self.highlight(filename, fullpath, spans), black(explanation))
 			i += 1
 		
 	def open(self, index):
@@ -75,7 +73,13 @@ class Repl(object):
 		else:
 			self.finder.find(Search(q))
 			search = self.finder.results()
-			self.summarise(search.results, search.text)
+			# (skipping refreshed results of earlier queries, sent while
+			# the prompt was up, and a slow search's results so far)
+			while search.text != q or not search.final:
+				search = self.finder.results()
+			self.summarise(search)
+			if self.opt.stats_path:
+				print black(status_line(self.finder.stats()))
 
 	def run(self):
 		work_thread = threading.Thread(target=self._run, name="repl")
@@ -90,9 +94,13 @@ class Repl(object):
 			pass
 
 	def _run(self):
-		self.finder = FileFinder(self.opt.base_path, path_filter=self.opt.path_filter, quit_indicator=QUITTING_TIME)
+		self.finder = self.opt.finder(QUITTING_TIME)
+		STARTUP.mark('finder')
 		logging.info("getting file list...")
 		self.finder.populate()
+		STARTUP.mark('index started')
+		# (the prompt is about to be shown)
+		STARTUP.mark('first frame')
 		try:
 			while True:
 				self._loop()
@@ -0,0 +1,116 @@
+import mmap
+import struct
+from array import array
+import Queue as queue
+from multiprocessing import Lock, Semaphore, RawValue
+from search import Search
+
+RING_SLOTS = 8
+# bytes per search; the least relevant results of a search that doesn't fit are dropped
+SLOT_SIZE = 64 * 1024
+
+# sent time, flags, text length, number of results, length of the paths
+HEADER = struct.Struct('<dBHHI')
+IS_REPEAT = 1
+FINAL = 2
+SENT = 4
+
+def _bytes(s):
+	# (names are latin-1 decoded on the way into the index)
+	return s.encode('iso-8859-1') if isinstance(s, unicode) else s
+
+class ResultRing(object):
+	"""
+	Carries searches (and their results) from the indexing process to the
+	UI through a ring of slots in shared memory, packed rather than
+	pickled. Has the put / get interface of the queue it replaces; it must
+	be created before the indexing process is forked, and read by just one
+	thread.
+	"""
+	def __init__(self, slots=RING_SLOTS, slot_size=SLOT_SIZE):
+		self._slots = slots
+		self._slot_size = slot_size
+		# (anonymous maps are shared with forked children)
+		self._buffer = mmap.mmap(-1, slots * slot_size)
+		self._filled = Semaphore(0)
+		self._free = Semaphore(slots)
+		self._write_lock = Lock()
+		self._head = RawValue('L', 0)
+		self._tail = 0
+
+	def put(self, search):
+		data = self._pack(search)
+		self._free.acquire()
+		with self._write_lock:
+			offset = (self._head.value % self._slots) * self._slot_size
+			self._buffer[offset:offset + len(data)] = data
+			self._head.value += 1
+		self._filled.release()
+
+	def get(self, block=True):
+		if not self._filled.acquire(block):
+			raise queue.Empty()
+		offset = (self._tail % self._slots) * self._slot_size
+		self._tail += 1
+		try:
+			return self._unpack(offset)
+		finally:
+			self._free.release()
+
+	def _pack(self, search):
+		"""
+		The header, the text, the length of each result's name (which is
+		the end of its path), how many spans each result has, the start
+		and end of every span, then the paths (separated by NULs)
+		"""
+		text = _bytes(search.text)
+		flags = ((IS_REPEAT if search.is_repeat else 0) | (FINAL if search.final else 0) |
+			(SENT if search.sent is not None else 0))
+		results = search.results or []
+		spans = search.spans or [()] * len(results)
+		while True:
+			paths = [path for name, path in results]
+			try:
+				# (encoding once is much quicker than encoding each path)
+				paths = u'\0'.join(paths).encode('iso-8859-1')
+			except UnicodeDecodeError:
+				paths = '\0'.join(map(_bytes, paths))
+			name_lengths = array('H', [len(name) for name, path in results])
+			span_counts = array('H', [len(result_spans) for result_spans in spans])
+			span_ends = array('H', [end for result_spans in spans for span in result_spans for end in span])
+			size = HEADER.size + len(text) + len(paths) + sum(
+				numbers.itemsize * len(numbers) for numbers in (name_lengths, span_counts, span_ends))
+			if size <= self._slot_size:
+				break
+			# (only the best that fit)
+			results = results[:len(results) * self._slot_size // size]
+			spans = spans[:len(results)]
+		header = HEADER.pack(search.sent or 0, flags, len(text), len(results), len(paths))
+		return ''.join([header, text, name_lengths.tostring(), span_counts.tostring(), span_ends.tostring(), paths])
+
+	def _unpack(self, offset):
+		buffer = self._buffer
+		sent, flags, text_length, count, paths_length = HEADER.unpack_from(buffer, offset)
+		offset += HEADER.size
+		search = Search(buffer[offset:offset + text_length], is_repeat=bool(flags & IS_REPEAT))
+		offset += text_length
+		search.final = bool(flags & FINAL)
+		search.sent = sent if flags & SENT else None
+		name_lengths = array('H')
+		name_lengths.fromstring(buffer[offset:offset + name_lengths.itemsize * count])
+		offset += name_lengths.itemsize * count
+		span_counts = array('H')
+		span_counts.fromstring(buffer[offset:offset + span_counts.itemsize * count])
+		offset += span_counts.itemsize * count
+		span_ends = array('H')
+		span_ends.fromstring(buffer[offset:offset + span_ends.itemsize * 2 * sum(span_counts)])
+		offset += span_ends.itemsize * len(span_ends)
+		paths = buffer[offset:offset + paths_length].decode('iso-8859-1').split(u'\0') if count else []
+		search.results = [(path[len(path) - length:], path) for path, length in zip(paths, name_lengths)]
+		search.spans = spans = []
+		position = 0
+		for span_count in span_counts:
+			end = position + 2 * span_count
+			spans.append(zip(span_ends[position:end:2], span_ends[position + 1:end:2]))
+			position = end
+		return search
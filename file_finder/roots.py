@@ -0,0 +1,114 @@
+import os
+import copy
+
+def _labels(paths):
+	"""a distinct directory name for each root, after its own name"""
+	labels = []
+	for path in paths:
+		name = os.path.basename(path.rstrip(os.path.sep)) or 'root'
+		label = name
+		number = 1
+		while label in labels:
+			number += 1
+			label = "%s-%d" % (name, number)
+		labels.append(label)
+	return labels
+
+class Roots(object):
+	"""
+	The trees being indexed. With more than one, each goes in the index
+	under a directory of its own (named after it), so every path in the
+	index is relative to an imaginary directory containing them all.
+	With just one, paths are relative to it as they always were.
+	"""
+	def __init__(self, paths, labels=None):
+		self.paths = [os.path.abspath(path) for path in paths]
+		self.labels = labels or _labels(self.paths)
+		# what each root's paths in the index start with
+		if len(self.paths) == 1:
+			self.prefixes = ['']
+		else:
+			self.prefixes = [label + os.path.sep for label in self.labels]
+
+	def __iter__(self):
+		"""(prefix, path) of each root"""
+		return iter(zip(self.prefixes, self.paths))
+
+	def __len__(self):
+		return len(self.paths)
+
+	def __str__(self):
+		return ', '.join(self.paths)
+
+	def resolved(self):
+		"""the same roots, with symlinks resolved (as the filesystem observer reports them)"""
+		return Roots(map(os.path.realpath, self.paths), self.labels)
+
+	def _root_of(self, path):
+		# (the deepest, should one root be inside another)
+		best = None
+		for prefix, root in self:
+			if path == root or path.startswith(root.rstrip(os.path.sep) + os.path.sep):
+				if best is None or len(root) > len(best[1]):
+					best = (prefix, root)
+		return best
+
+	def relative(self, path):
+		"""the index's path for the (absolute) `path`, or None if it isn't under any root"""
+		root = self._root_of(path)
+		if root is None:
+			return None
+		prefix, root = root
+		relpath = os.path.relpath(path, root)
+		if not prefix:
+			return relpath
+		return prefix.rstrip(os.path.sep) if relpath == os.curdir else prefix + relpath
+
+	def relative_dir(self, path):
+		"""the index's path for the directory at (absolute) `path`, with a trailing separator"""
+		relpath = self.relative(path)
+		return '' if relpath == os.curdir else relpath + os.path.sep
+
+	def absolute(self, relpath):
+		"""where the index's `relpath` is on disk"""
+		for prefix, root in self:
+			if relpath.startswith(prefix):
+				return os.path.join(root, relpath[len(prefix):])
+		raise ValueError("%s isn't under any of %s" % (relpath, self))
+
+class RootsFilter(object):
+	"""
+	A PathFilter for each of several roots, applied to the paths of that
+	root's files (without its prefix), so that excludes are matched and
+	ignore files are read just as they would be for that root alone
+	"""
+	def __init__(self, roots, path_filter, use_ignore_files=False):
+		self.exclude_paths = path_filter.exclude_paths
+		self.include_files = path_filter.include_files
+		self._filters = []
+		for prefix, root in roots:
+			root_filter = copy.copy(path_filter)
+			if use_ignore_files:
+				root_filter.use_ignore_files(root)
+			self._filters.append((prefix, root_filter))
+
+	def _split(self, path):
+		for prefix, path_filter in self._filters:
+			if path.startswith(prefix):
+				return path_filter, path[len(prefix):]
+		return None, path
+
+	def should_include(self, path, is_file=False):
+		path_filter, path = self._split(path)
+		if path_filter is None:
+			# (the directory containing the roots)
+			return not is_file
+		return path_filter.should_include(path, is_file)
+
+	def rules_stamp(self, directory):
+		path_filter, directory = self._split(directory)
+		return None if path_filter is None else path_filter.rules_stamp(directory)
+
+	def ignore_files_changed(self, directory):
+		path_filter, directory = self._split(directory)
+		return path_filter is not None and path_filter.ignore_files_changed(directory)
@@ -0,0 +1,113 @@
+import re
+import heapq
+
+SEPARATORS = set('/_-. ')
+
+BOUNDARY_BONUS = 8
+BASENAME_BONUS = 10
+BASENAME_START_BONUS = 6
+ADJACENT_BONUS = 4
+EXACT_BONUS = 20
+MAX_GAP_PENALTY = 10
+LENGTH_PENALTY = 0.1
+
+# how many rows to score between checking whether to give up
+INTERRUPT_CHECK_INTERVAL = 256
+
+class Scorer(object):
+	"""
+	Matches (name, path) rows against a query with the same semantics as
+	the DB's LIKE patterns (spaces are wildcards, slashes search the whole path,
+	^ and $ anchor), and scores how good each match is.
+	"""
+	def __init__(self, query):
+		self.match_path = '/' in query
+		text = query.rstrip('$').lstrip('^').replace('/', ' ')
+		self.anchor_start = anchor_start = query.startswith('^') and not text.startswith(' ')
+		self.anchor_end = anchor_end = query.endswith('$') and not text.endswith(' ')
+		self.fragments = fragments = text.split()
+		self.exact_name = text.strip().lower() if len(fragments) == 1 else None
+
+		groups = ["(%s)" % (re.escape(fragment),) for fragment in fragments]
+		suffix = '$' if anchor_end else ''
+		# leftmost and rightmost alignment of the fragments
+		self._earliest = re.compile(('^' if anchor_start else '^.*?') + '.*?'.join(groups) + suffix, re.I | re.S)
+		self._latest = re.compile(('^' if anchor_start else '^.*') + '.*'.join(groups) + suffix, re.I | re.S)
+
+	def __call__(self, name, path):
+		"""the score of a row, or None if it doesn't match"""
+		target = path if self.match_path else name
+		earliest = self._earliest.match(target)
+		if earliest is None:
+			return None
+		basename_start = len(target) - len(name)
+		score = max(
+			self._score_spans(target, earliest, basename_start),
+			self._score_spans(target, self._latest.match(target), basename_start))
+		if self.exact_name is not None and name.lower() == self.exact_name:
+			score += EXACT_BONUS
+		return score - len(path) * LENGTH_PENALTY
+
+	def spans(self, name, path):
+		"""
+		The (start, end) within `path` of each fragment, as aligned in the
+		match that was scored (or [] if the row doesn't match)
+		"""
+		target = path if self.match_path else name
+		earliest = self._earliest.match(target)
+		if earliest is None:
+			return []
+		basename_start = len(target) - len(name)
+		# (the same alignment that __call__ scores by, preferring the earliest)
+		match = max(earliest, self._latest.match(target),
+			key=lambda match: self._score_spans(target, match, basename_start))
+		offset = len(path) - len(target)
+		return [(start + offset, end + offset) for start, end in
+			(match.span(group) for group in range(1, match.lastindex + 1 if match.lastindex else 1))]
+
+	def _score_spans(self, target, match, basename_start):
+		score = 0
+		previous_end = None
+		for group in range(1, match.lastindex + 1 if match.lastindex else 1):
+			start, end = match.span(group)
+			if start == 0 or target[start-1] in SEPARATORS or (
+					target[start-1].islower() and target[start].isupper()):
+				score += BOUNDARY_BONUS
+			if start >= basename_start:
+				score += BASENAME_BONUS
+				if start == basename_start:
+					score += BASENAME_START_BONUS
+			if previous_end is not None:
+				gap = start - previous_end
+				score += ADJACENT_BONUS if gap == 0 else -min(gap, MAX_GAP_PENALTY)
+			previous_end = end
+		return score
+
+def top_matches(scorer, rows, limit, keep=0, interrupted=None):
+	"""
+	Score every row, keeping only the best `limit` in a bounded heap.
+	Returns (best rows, all matching rows or None if there were more than `keep`,
+	whether every row was considered before `interrupted()` returned true).
+	"""
+	heap = []
+	matched = []
+	complete = True
+	for index, row in enumerate(rows):
+		if interrupted is not None and index % INTERRUPT_CHECK_INTERVAL == 0 and index and interrupted():
+			complete = False
+			break
+		name, path = row
+		score = scorer(name, path)
+		if score is None:
+			continue
+		if matched is not None:
+			matched.append(row)
+			if len(matched) > keep:
+				matched = None
+		entry = (score, -len(path), row)
+		if len(heap) < limit:
+			heapq.heappush(heap, entry)
+		elif entry > heap[0]:
+			heapq.heapreplace(heap, entry)
+	best = sorted(heap, key=lambda (score, length, (name, path)): (-score, -length, name, path))
+	return [row for score, length, row in best], matched, complete
@@ -1,8 +1,23 @@
 class Search(object):
-	def __init__(self, text, is_repeat=False):
+	def __init__(self, text, is_repeat=False, origin=None):
 		self.text = text
 		self.is_repeat = is_repeat
+		# who asked, when many clients share an index (a newer search
+		# only supersedes older ones from the same origin)
+		self.origin = origin
 		self.results = None
+		# the matched parts of each result's path, as [(start, end), ...]
+		self.spans = None
+		# when the results were sent from the indexing process
+		self.sent = None
+		# whether these are the last results this search will get
+		# (a slow search sends its best results so far first)
+		self.final = True
 
 	def __nonzero__(self):
 		return bool(self.text)
+
+# what an empty query finds
+EMPTY_RESULTS = Search('')
+EMPTY_RESULTS.results = []
+EMPTY_RESULTS.spans = []
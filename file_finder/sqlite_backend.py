@@ -0,0 +1,389 @@
+import os
+import fcntl
+import shutil
+import tempfile
+import logging
+import sqlite3
+from backend import Backend, adapt_str, to_unicode, dir_path, split_path
+
+sqlite3.register_adapter(str, adapt_str)
+
+# sqlite VM instructions between checks for a cancelled search
+PROGRESS_INTERVAL = 1000
+
+# bumped whenever the tables change, so that stale persistent indexes get rebuilt
+SCHEMA_VERSION = 3
+TABLES = ("files", "dirs", "trigrams", "file_trigrams", "dir_trigrams")
+
+def trigrams(text):
+	text = to_unicode(text).lower()
+	return set(text[i:i+3] for i in range(len(text) - 2))
+
+class SqliteBackend(Backend):
+	"""
+	Keeps the index in an sqlite file: either persistent (at index_path),
+	or a scratch file that is thrown away afterwards. The writer
+	and the search thread each have their own connection.
+	"""
+	persistent = True
+	needs_scratch_dir = True
+
+	def __init__(self, index_path=None, scratch_dir=None, prepare=True):
+		# (held for as long as this backend writes to a persistent index)
+		self._lock_file = None
+		if index_path is not None and prepare and not self._lock(index_path):
+			# each writer has its own ids for new rows, so only one can use it
+			logging.info("%s is in use by another finder, so this one keeps its own index" % (index_path,))
+			index_path = None
+		# without a persistent index, the tables go in a scratch file so
+		# that searches and file events can each have their own connection
+		self._scratch_dir = None
+		if index_path is None:
+			self._scratch_dir = scratch_dir or tempfile.mkdtemp(prefix='file-finder-')
+			index_path = os.path.join(self._scratch_dir, 'index.sqlite')
+		self.index_path = index_path
+		# (path -> id) for every row in the dirs table
+		self.dir_ids = {}
+		if prepare:
+			self._prepare_index()
+
+	def _lock(self, index_path):
+		"""take the persistent index for writing, returning whether nobody else has it"""
+		index_dir = os.path.dirname(index_path)
+		if not os.path.isdir(index_dir):
+			os.makedirs(index_dir)
+		lock_file = open(index_path + '.lock', 'a')
+		try:
+			# (released when the process exits, however it goes)
+			fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except IOError:
+			lock_file.close()
+			return False
+		self._lock_file = lock_file
+		return True
+
+	@classmethod
+	def open_existing(cls, index_path):
+		if not os.path.exists(index_path):
+			return None
+		# (another finder may be using the index, so it's left just as it is)
+		backend = cls(index_path, prepare=False)
+		try:
+			backend.open_reader()
+			backend.reader.execute("PRAGMA query_only = ON")
+			(version,), = backend.reader.execute("PRAGMA user_version")
+		except sqlite3.DatabaseError, e:
+			logging.info("can't read the index at %s: %s" % (index_path, e))
+			return None
+		if version != SCHEMA_VERSION:
+			logging.info("the index at %s is outdated" % (index_path,))
+			backend.close()
+			return None
+		return backend
+
+	# poll_events owns the writing connection (self.db), and searches
+	# run on a separate reading connection (self.reader). WAL mode gives
+	# each query a consistent snapshot of the index, without waiting
+	# for the writer.
+	def open(self):
+		self.db = self._connect()
+		self.dir_ids = dict(self.execute("SELECT path, id FROM dirs"))
+		(count, max_id), = self.execute("SELECT count(*), max(id) FROM files")
+		self._next_file_id = (max_id or 0) + 1
+		if count:
+			logging.info("loaded %s files from %s" % (count, self.index_path))
+		return count
+
+	def open_reader(self):
+		self.reader = self._connect()
+
+	def transaction(self):
+		# changes are committed once per batch
+		return self.db
+
+	def execute(self, query, params=(), return_count=False, db=None):
+		cursor = (db or self.db).cursor()
+		if params:
+			result = cursor.execute(query, params)
+			return cursor.rowcount if return_count else result
+		else:
+			return cursor.execute(query)
+
+	def candidates(self, query, interrupted, interruption):
+		"""
+		Rows from the trigram-filtered query, until sqlite is interrupted by
+		the progress handler, which is noted in `interruption` so the rows seen
+		so far are treated as a partial result.
+		"""
+		self.reader.set_progress_handler(interrupted, PROGRESS_INTERVAL)
+		try:
+			for row in self._find_in_db(query):
+				yield row
+		except sqlite3.OperationalError, e:
+			if 'interrupted' not in str(e): raise
+			logging.debug("search interrupted")
+			interruption.append(True)
+		finally:
+			self.reader.set_progress_handler(None, PROGRESS_INTERVAL)
+
+	def _find_in_db(self, query):
+		query_type, query = self._split_query(query)
+		query_param = self._format_like_statement(query)
+		candidate_sql, candidate_params = self._trigram_candidates(query, query_type)
+
+		# no ORDER BY, so that rows stream straight into the scorer
+		column = "files.name" if query_type == 'name' else "dirs.path || files.name"
+		sql = ("SELECT DISTINCT files.name, dirs.path || files.name FROM files JOIN dirs ON dirs.id = files.dir_id " +
+		      "WHERE %s%s LIKE ? escape '\\'" % (candidate_sql, column))
+		logging.debug("%s :: %s" % (sql, query_param))
+		return self.execute(sql, candidate_params + [query_param], db=self.reader)
+
+	def _split_query(self, query):
+		if '/' in query:
+			return 'path', query.replace('/', ' ')
+		else:
+			return 'name', query
+
+	def _trigram_candidates(self, query, query_type):
+		"""
+		Every literal chunk of the query must appear somewhere in a matching file,
+		so only files containing all of its trigrams are candidates. Chunks never
+		contain a slash, so for path queries each chunk lies entirely within
+		either the file's name or its directory's path.
+		Returns an SQL condition (or '' if the query is too short to use) and its params.
+		"""
+		def intersection(select, query_trigrams):
+			return " INTERSECT ".join([select] * len(query_trigrams))
+		name_select = "SELECT file_id FROM file_trigrams WHERE tri = ?"
+		dir_select = "SELECT dir_id FROM dir_trigrams WHERE tri = ?"
+
+		fragments = [list(trigrams(fragment)) for fragment in query.rstrip('$').lstrip('^').split()]
+		fragments = [fragment for fragment in fragments if fragment]
+		if not fragments:
+			return '', []
+		if query_type == 'name':
+			query_trigrams = list(set(sum(fragments, [])))
+			return "files.id IN (%s) AND " % (intersection(name_select, query_trigrams),), query_trigrams
+
+		subqueries = []
+		params = []
+		for query_trigrams in fragments:
+			subqueries.append("SELECT * FROM (%s UNION SELECT id FROM files WHERE dir_id IN (%s))" % (
+				intersection(name_select, query_trigrams),
+				intersection(dir_select, query_trigrams)))
+			params.extend(query_trigrams * 2)
+		return "files.id IN (%s) AND " % (" INTERSECT ".join(subqueries),), params
+
+	def _format_like_statement(self, query):
+		# psuedo-regexp anchoring
+		prefix = '' if query.startswith('^') else '%'
+		suffix = '' if query.endswith('$')   else '%'
+
+		query = query.rstrip('$').lstrip('^')
+		query = query.replace('\\', '\\\\')
+		query = query.replace('_', '\\_')
+		query = query.replace('%', '\\%')
+		wildcarded_query = query.replace(" ", "%")
+		query_param = "%s%s%s" % (prefix, wildcarded_query, suffix)
+
+		return query_param
+
+	def _connect(self):
+		index_dir = os.path.dirname(self.index_path)
+		if not os.path.isdir(index_dir):
+			os.makedirs(index_dir)
+		db = sqlite3.connect(self.index_path)
+		db.execute("PRAGMA journal_mode=WAL")
+		# a scratch index isn't worth syncing to disk
+		db.execute("PRAGMA synchronous=%s" % ("OFF" if self._scratch_dir else "NORMAL",))
+		return db
+
+	def _create_tables(self, db):
+		# each directory's path is stored once, files only store their name
+		db.execute("CREATE TABLE IF NOT EXISTS dirs ( id INTEGER PRIMARY KEY, parent_id INTEGER, " +
+			"name VARCHAR(255), path VARCHAR(255), mtime REAL, rules INTEGER)")
+		db.execute("CREATE UNIQUE INDEX IF NOT EXISTS dirs_path ON dirs (path)")
+		db.execute("CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent_id)")
+		db.execute("CREATE TABLE IF NOT EXISTS files ( id INTEGER PRIMARY KEY, dir_id INTEGER, name VARCHAR(255))")
+		db.execute("CREATE INDEX IF NOT EXISTS files_dir ON files (dir_id)")
+		# posting lists: the ids of every file whose (lowercased) name,
+		# and every directory whose path, contains `tri`
+		db.execute("CREATE TABLE IF NOT EXISTS file_trigrams ( tri VARCHAR(3), file_id INTEGER, " +
+			"PRIMARY KEY (tri, file_id)) WITHOUT ROWID")
+		db.execute("CREATE TABLE IF NOT EXISTS dir_trigrams ( tri VARCHAR(3), dir_id INTEGER, " +
+			"PRIMARY KEY (tri, dir_id)) WITHOUT ROWID")
+		db.execute("PRAGMA user_version = %d" % (SCHEMA_VERSION,))
+		db.commit()
+
+	def _prepare_index(self):
+		db = self._connect()
+		try:
+			(version,), = db.execute("PRAGMA user_version")
+			if version != SCHEMA_VERSION:
+				if version:
+					logging.info("rebuilding outdated index %s" % (self.index_path,))
+				for table in TABLES:
+					db.execute("DROP TABLE IF EXISTS %s" % (table,))
+			self._create_tables(db)
+		finally:
+			db.close()
+
+	def load_dirs(self):
+		"""
+		The (path -> (mtime, rules)) mapping of every directory listed into
+		a persistent index, for the watcher to skip unchanged directories.
+		"""
+		if self._scratch_dir is not None or not os.path.exists(self.index_path):
+			return {}
+		db = self._connect()
+		try:
+			return dict((path.encode("iso-8859-1"), (mtime, rules)) for path, mtime, rules in
+				db.execute("SELECT path, mtime, rules FROM dirs WHERE mtime IS NOT NULL"))
+		except sqlite3.OperationalError:
+			return {}
+		finally:
+			db.close()
+
+	def close(self):
+		self.reader.close()
+		if self._scratch_dir is not None:
+			shutil.rmtree(self._scratch_dir, ignore_errors=True)
+
+	def _dir_id(self, path):
+		"""the id of the directory at `path` (see dir_path), creating it if need be"""
+		dir_id = self.dir_ids.get(path)
+		if dir_id is None:
+			if path:
+				parent, name = split_path(path.rstrip(os.path.sep))
+				parent_id = self._dir_id(parent)
+			else:
+				parent_id, name = None, u''
+			dir_id = self.execute("INSERT INTO dirs (parent_id, name, path) VALUES (?, ?, ?)",
+				(parent_id, name, path)).lastrowid
+			self.db.executemany("INSERT INTO dir_trigrams (tri, dir_id) VALUES (?, ?)",
+				[(tri, dir_id) for tri in trigrams(path)])
+			self.dir_ids[path] = dir_id
+		return dir_id
+
+	def _file_names(self, dir_id):
+		return set(name for (name,) in self.execute("SELECT name FROM files WHERE dir_id = ?", (dir_id,)))
+
+	def add_files(self, files):
+		if not files: return 0
+		by_dir = {}
+		for path, name in files:
+			by_dir.setdefault(path, set()).add(to_unicode(name))
+		rows = []
+		for path, names in by_dir.iteritems():
+			if path in self.dir_ids:
+				dir_id = self.dir_ids[path]
+				names -= self._file_names(dir_id)
+			else:
+				dir_id = self._dir_id(path)
+			rows.extend((dir_id, name) for name in names)
+		return self._insert_files(rows)
+
+	def _insert_files(self, rows):
+		if not rows: return 0
+		# ids are handed out here so that the trigram rows can be
+		# inserted in bulk alongside the files that they point to
+		first_id = self._next_file_id
+		self._next_file_id += len(rows)
+		rows = [(file_id, dir_id, name) for file_id, (dir_id, name) in enumerate(rows, first_id)]
+		self.db.executemany("INSERT INTO files (id, dir_id, name) VALUES (?, ?, ?)", rows)
+		self.db.executemany("INSERT OR IGNORE INTO file_trigrams (tri, file_id) VALUES (?, ?)",
+			((tri, file_id) for file_id, dir_id, name in rows for tri in trigrams(name)))
+		return len(rows)
+
+	def remove_file(self, path):
+		path, name = split_path(path)
+		dir_id = self.dir_ids.get(path)
+		if dir_id is None: return 0
+		return self._remove_file(dir_id, name)
+
+	def _remove_file(self, dir_id, name):
+		file_ids = self.execute("SELECT id FROM files WHERE dir_id = ? AND name = ?", (dir_id, name)).fetchall()
+		for (file_id,) in file_ids:
+			self._remove_trigrams("file_trigrams", "file_id", file_id, name)
+		self.execute("DELETE FROM files WHERE dir_id = ? AND name = ?", (dir_id, name))
+		return -len(file_ids)
+
+	def _remove_trigrams(self, table, column, row_id, text):
+		self.db.executemany("DELETE FROM %s WHERE tri = ? AND %s = ?" % (table, column),
+			[(tri, row_id) for tri in trigrams(text)])
+
+	def _subtree(self, dir_id):
+		"""(id, path) of a directory and everything beneath it"""
+		return self.execute("WITH RECURSIVE subtree(id) AS (" +
+				"SELECT ? UNION ALL SELECT dirs.id FROM dirs JOIN subtree ON dirs.parent_id = subtree.id) " +
+			"SELECT dirs.id, dirs.path FROM subtree JOIN dirs ON dirs.id = subtree.id", (dir_id,)).fetchall()
+
+	def remove_dir(self, path):
+		dir_id = self.dir_ids.get(dir_path(path))
+		if dir_id is None: return 0
+		subtree = self._subtree(dir_id)
+		files_deleted = 0
+		for subdir_id, subdir_path in subtree:
+			for file_id, name in self.execute("SELECT id, name FROM files WHERE dir_id = ?", (subdir_id,)).fetchall():
+				self._remove_trigrams("file_trigrams", "file_id", file_id, name)
+				files_deleted += 1
+			self._remove_trigrams("dir_trigrams", "dir_id", subdir_id, subdir_path)
+			del self.dir_ids[subdir_path]
+		self.db.executemany("DELETE FROM files WHERE dir_id = ?", [(subdir_id,) for subdir_id, subdir_path in subtree])
+		self.db.executemany("DELETE FROM dirs WHERE id = ?", [(subdir_id,) for subdir_id, subdir_path in subtree])
+		return -files_deleted
+
+	def move_file(self, src, dest):
+		src_dir, src_name = split_path(src)
+		dest_dir, dest_name = split_path(dest)
+		src_dir_id = self.dir_ids.get(src_dir)
+		file_ids = [] if src_dir_id is None else self.execute(
+			"SELECT id FROM files WHERE dir_id = ? AND name = ?", (src_dir_id, src_name)).fetchall()
+		if not file_ids:
+			return self.add_files([(dest_dir, dest_name)])
+		dest_dir_id = self._dir_id(dest_dir)
+		# a move can replace an existing file
+		removed = self._remove_file(dest_dir_id, dest_name)
+		for (file_id,) in file_ids:
+			self.execute("UPDATE files SET dir_id = ?, name = ? WHERE id = ?", (dest_dir_id, dest_name, file_id))
+			if dest_name != src_name:
+				self._remove_trigrams("file_trigrams", "file_id", file_id, src_name)
+				self.db.executemany("INSERT OR IGNORE INTO file_trigrams (tri, file_id) VALUES (?, ?)",
+					[(tri, file_id) for tri in trigrams(dest_name)])
+		return removed
+
+	def move_dir(self, src, dest):
+		"""
+		Re-parent a directory, rewriting only the paths in its subtree.
+		Files refer to their directory by id, so they stay untouched.
+		"""
+		src = dir_path(src)
+		dest = dir_path(dest)
+		dir_id = self.dir_ids.get(src)
+		if dir_id is None: return None
+		if src == dest: return 0
+		# a move can replace an existing (empty) directory
+		removed = self.remove_dir(dest)
+		parent, name = split_path(dest.rstrip(os.path.sep))
+		self.execute("UPDATE dirs SET parent_id = ?, name = ? WHERE id = ?", (self._dir_id(parent), name, dir_id))
+		for subdir_id, subdir_path in self._subtree(dir_id):
+			new_path = dest + subdir_path[len(src):]
+			self._remove_trigrams("dir_trigrams", "dir_id", subdir_id, subdir_path)
+			self.db.executemany("INSERT OR IGNORE INTO dir_trigrams (tri, dir_id) VALUES (?, ?)",
+				[(tri, subdir_id) for tri in trigrams(new_path)])
+			self.execute("UPDATE dirs SET path = ? WHERE id = ?", (new_path, subdir_id))
+			del self.dir_ids[subdir_path]
+			self.dir_ids[new_path] = subdir_id
+		return removed
+
+	def update_dir(self, path, mtime, names, rules=None):
+		dir_id = self._dir_id(dir_path(path))
+		names = set(map(to_unicode, names))
+		existing = self._file_names(dir_id)
+		removed = 0
+		for name in existing - names:
+			removed += self._remove_file(dir_id, name)
+		# (the walker has already filtered the listing)
+		added = self._insert_files([(dir_id, name) for name in names - existing])
+		self.execute("UPDATE dirs SET mtime = ?, rules = ? WHERE id = ?", (mtime, rules, dir_id))
+		return added + removed
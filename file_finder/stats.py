@@ -0,0 +1,149 @@
+import time
+import threading
+from bisect import bisect_left
+
+# histogram bucket upper bounds, in milliseconds (the last bucket is unbounded)
+BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+# seconds between snapshots sent from the indexing process
+REPORT_INTERVAL = 1.0
+
+class Histogram(object):
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.buckets = [0] * (len(BUCKETS) + 1)
+
+	def add(self, ms):
+		self.count += 1
+		self.total += ms
+		self.max = max(self.max, ms)
+		self.buckets[bisect_left(BUCKETS, ms)] += 1
+
+	def percentile(self, p):
+		"""the upper bound of the bucket holding the p'th percentile"""
+		rank = p / 100.0 * self.count
+		seen = 0
+		for bound, count in zip(BUCKETS, self.buckets):
+			seen += count
+			if seen >= rank:
+				return round(min(bound, self.max), 3)
+		return round(self.max, 3)
+
+	def as_dict(self):
+		return {
+			'count': self.count,
+			'mean_ms': round(self.total / self.count, 3) if self.count else 0,
+			'p50_ms': self.percentile(50),
+			'p99_ms': self.percentile(99),
+			'max_ms': round(self.max, 3),
+			'buckets_ms': dict(zip(map(str, BUCKETS) + ['inf'], self.buckets)),
+		}
+
+class Timer(object):
+	def __init__(self, stats, name):
+		self.stats = stats
+		self.name = name
+
+	def __enter__(self):
+		self.started = time.time()
+		return self
+
+	def __exit__(self, *exc_info):
+		self.stats.record(self.name, time.time() - self.started)
+
+class Stats(object):
+	"""
+	Counters, latency histograms and queue depths for each stage of the
+	finder. Every process has its own (see STATS), and the indexing
+	process sends snapshots of its stats to the UI.
+	"""
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.counters = {}
+		self.histograms = {}
+		self.depths = {}
+
+	def count(self, name, n=1):
+		with self._lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+
+	def record(self, name, seconds):
+		with self._lock:
+			histogram = self.histograms.get(name)
+			if histogram is None:
+				histogram = self.histograms[name] = Histogram()
+			histogram.add(seconds * 1000)
+
+	def timer(self, name):
+		"""a context manager recording how long its block takes"""
+		return Timer(self, name)
+
+	def depth(self, name, size):
+		with self._lock:
+			current, peak = self.depths.get(name, (0, 0))
+			self.depths[name] = (size, max(peak, size))
+
+	def snapshot(self):
+		with self._lock:
+			return {
+				'counters': dict(self.counters),
+				'latency': dict((name, histogram.as_dict()) for name, histogram in self.histograms.items()),
+				'queues': dict((name, {'depth': current, 'peak': peak}) for name, (current, peak) in self.depths.items()),
+			}
+
+STATS = Stats()
+
+def merge(*snapshots):
+	"""combine snapshots from different processes (which track different stages)"""
+	merged = {'counters': {}, 'latency': {}, 'queues': {}}
+	for snapshot in snapshots:
+		for key in merged:
+			merged[key].update(snapshot.get(key, {}))
+	return merged
+
+STATUS_STAGES = ('walk', 'insert', 'query', 'results', 'draw')
+STATUS_QUEUES = (('event_queue', 'ev'), ('dir_queue', 'dir'), ('dbqueue', 'db'))
+
+def status_line(snapshot):
+	"""a one-line summary: p99 latency per stage, then current queue depths"""
+	parts = []
+	for name in STATUS_STAGES:
+		latency = snapshot['latency'].get(name)
+		if latency:
+			parts.append("%s %sms" % (name, latency['p99_ms']))
+	depths = ["%s %d" % (label, snapshot['queues'][name]['depth'])
+		for name, label in STATUS_QUEUES if name in snapshot['queues']]
+	if depths:
+		parts.append("queued: " + ", ".join(depths))
+	return " | ".join(parts)
+
+def dump(snapshot, path):
+	import json
+	snapshot = dict(snapshot, time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+	with open(path, 'w') as f:
+		json.dump(snapshot, f, indent=2, sort_keys=True)
+
+class StartupProfile(object):
+	"""
+	When each stage of starting up finished, to show where the time goes
+	before the first frame is drawn (see --startup-profile)
+	"""
+	def __init__(self):
+		# (the finder script moves this back to before its imports)
+		self.started = time.time()
+		self.stages = []
+
+	def mark(self, stage):
+		self.stages.append((stage, time.time()))
+
+	def report(self):
+		lines = ["startup: %-16s %10s %10s" % ('', 'total ms', 'stage ms')]
+		previous = self.started
+		for stage, finished in self.stages:
+			lines.append("         %-16s %10.1f %10.1f" % (
+				stage, (finished - self.started) * 1000, (finished - previous) * 1000))
+			previous = finished
+		return "\n".join(lines)
+
+STARTUP = StartupProfile()
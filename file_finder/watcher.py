@@ -1,12 +1,33 @@
 #!/usr/bin/env python
 import os
-import re
+import errno
 import Queue as queue
+import time
 import logging
-from threading import Thread
+from threading import Thread, Condition
 
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler, FileCreatedEvent
+from watchdog.events import FileSystemEventHandler
+
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		logging.info("can't import scandir - install it for faster scanning")
+		scandir = None
+
+from stats import STATS
+from path_filter import IGNORE_FILES
+from roots import Roots
+import git_index
+
+DEFAULT_SCAN_THREADS = 4
+# a directory with more than this many pending file events is rescanned instead
+STORM_EVENTS = 64
+# how long (in seconds) events are left to gather before they're handed on
+COALESCE_LATENCY = 0.1
 
 class AddFileEvent(object):
 	def __init__(self, path, name):
@@ -16,89 +37,226 @@ class AddFileEvent(object):
 
 class TreeWatcher(object):
 	"""
-	TreeWatcher Class keeps track of all files down a tree starting at the root,
-	appending events to the end of event_queue.
+	TreeWatcher Class keeps track of all files down a tree starting at the root
+	(or down each of several Roots), appending events to the end of event_queue.
 	Spawns an inotify watcher thread and then watches the queue indefinitely
 	"""
 
-	def __init__(self, root, event_queue, ignored_dir_regexes=()):
+	def __init__(self, roots, event_queue, path_filter, known_dirs=None, threads=DEFAULT_SCAN_THREADS,
+			seed_from_git=False):
+		# (absolute directory path, whether to prune it) - see walk_directory
 		self._dir_queue = queue.Queue()
-		self._root = os.path.realpath(root)
+		self._seed_from_git = seed_from_git
+		self._threads = max(1, threads)
+		if not isinstance(roots, Roots):
+			roots = Roots([roots])
+		self._roots = roots.resolved()
+		self._event_queue = event_queue
 
-		# Add a watch to the root of the dir
-		self._handler = FileFinderEventHandler(event_queue=event_queue, directory_queue=self._dir_queue, root=self._root)
+		# directories (and their (mtime, rules stamp)) already present in a persistent index
+		self._known_dirs = known_dirs or {}
+		self._known_subdirs = {}
+		for path in self._known_dirs:
+			if path:
+				parent = os.path.dirname(path.rstrip(os.path.sep))
+				parent = parent + os.path.sep if parent else ''
+				self._known_subdirs.setdefault(parent, []).append(path)
+
+		# Add a watch to the root of each tree
+		self._events = EventCoalescer(event_queue, self._dir_queue, rescan=self.rescan_dir)
+		self._handler = FileFinderEventHandler(events=self._events, roots=self._roots, path_filter=path_filter)
 		notifier = Observer()
 		notifier.name = "[inotify] notifier"
 		notifier.daemon = True
 		self.notifier = notifier
-		self._ignored_dir_res = ignored_dir_regexes
+		self._path_filter = path_filter
 
 	def run_forever(self):
 		def spawn_watcher():
 			# watcher *should* be in its own thread, but the setup stage isn't,
 			# and takes ages on a big tree
-			self.notifier.schedule(self._handler, self._root, recursive=True)
+			for root in self._roots.paths:
+				self.notifier.schedule(self._handler, root, recursive=True)
 			self.notifier.start()
 
+		self._events.start()
 		spawn_watcher_thread = Thread(target=spawn_watcher, name='[inotify] spawn_watcher')
 		spawn_watcher.daemon = True
 		spawn_watcher_thread.start()
+		self.scan()
 
-		self.add_dir(self._root)
+	def scan(self):
+		"""walk the whole tree, then keep handling directories queued by the notifier"""
+		if self._seed_from_git:
+			self.seed_from_git()
+		# listing directories is mostly spent waiting on the filesystem, so a few
+		# threads can work through the directory queue at once
+		for root in self._roots.paths:
+			self._dir_queue.put((root, False))
+		for i in range(self._threads - 1):
+			scanner = Thread(target=self._watch_queue, name='[scanner] %d' % (i+1,))
+			scanner.daemon = True
+			scanner.start()
 		self._watch_queue()
 	
 	def _watch_queue(self):
 		while True:
-			directory, exists = self._dir_queue.get()
-			if exists:
-				self.add_dir(directory)
-			else:
-				logging.debug("got nonexistent directory: %s" % (directory,))
+			directory, prune = self._dir_queue.get()
+			STATS.depth('dir_queue', self._dir_queue.qsize())
+			self.add_dir(directory, prune)
+
+	def seed_from_git(self):
+		"""
+		Send the files tracked by git (for each root that's in a checkout)
+		straight from its index file, so that they can be searched before the
+		walk (which still follows, to pick up untracked files) gets to them.
+		"""
+		for root_prefix, root in self._roots:
+			self._seed_root_from_git(root_prefix, root)
 
-	def _should_skip_path(self, path):
-		for pattern in self._ignored_dir_res:
-			if re.search(pattern, path):
-				return True
-		return False
+	def _seed_root_from_git(self, root_prefix, root):
+		index_path, prefix = git_index.find_index(root)
+		if index_path is None:
+			logging.info("%s isn't in a git checkout, so there's nothing to seed" % (root,))
+			return
+		started = time.time()
+		by_dir = {}
+		try:
+			for path in git_index.tracked_files(index_path):
+				if not path.startswith(prefix): continue
+				base, name = os.path.split(path[len(prefix):])
+				by_dir.setdefault(root_prefix + base + os.path.sep if base else root_prefix, []).append(name)
+		except (IOError, git_index.GitIndexError), e:
+			logging.warn("can't seed from %s: %s" % (index_path, e))
+			return
+		STATS.record('seed', time.time() - started)
+		for base, names in by_dir.iteritems():
+			if not self._path_filter.should_include(base): continue
+			names = [name for name in names if self._path_filter.should_include(base + name, is_file=True)]
+			if not names: continue
+			STATS.count('seed.files', len(names))
+			self._event_queue.put(Event(base=base, event=Event.SEEDED, exists=True, names=names))
 
-	def add_dir(self, path):
-		if not self._should_skip_path(path):
-			self.walk_directory(path)
+	def add_dir(self, path, prune=False):
+		if self._path_filter.should_include(self._relative_dir(path)):
+			self.walk_directory(path, prune)
 
-	def add_file(self, path, name):
-		self._handler.on_created(FileCreatedEvent(os.path.join(path,name)))
+	def _relative_dir(self, path):
+		return self._roots.relative_dir(path)
 
-	def walk_directory(self, root):
+	def walk_directory(self, root, prune=False):
 		"""
-		From a give root of a tree this method will walk through every branch
-		and return a generator.
+		List a single directory, queueing its subdirectories and
+		sending its files to the event queue as one listing.
+		Directories whose mtime (and ignore files) match the
+		persistent index are not listed at all - only their known
+		subdirectories are visited. Pruning (when the ignore rules
+		have changed) also drops every excluded subdirectory, in case
+		it was indexed under the old rules.
 		"""
 		logging.debug("walking %s" % (root,))
+		relpath = self._relative_dir(root)
+		known_subdirs = self._known_subdirs.pop(relpath, [])
+		known = self._known_dirs.pop(relpath, None)
 		try:
-			names = os.listdir(root)
-			for name in names:
+			mtime = os.stat(root).st_mtime
+			# (editing an ignore file in place leaves its directory's mtime alone)
+			rules = self._path_filter.rules_stamp(relpath)
+			if (mtime, rules) == known:
+				STATS.count('walk.unchanged')
+				for subdir in known_subdirs:
+					self._dir_queue.put((self._roots.absolute(subdir), prune))
+				return
+
+			started = time.time()
+			entries = list(self._list(root))
+			listed = time.time()
+			names = []
+			subdirs = set()
+			excluded = []
+			for name, is_dir in entries:
+				if is_dir:
+					subdir = relpath + name + os.path.sep
+					# excluded directories are never listed
+					if self._path_filter.should_include(subdir):
+						self._dir_queue.put((os.path.join(root, name), prune))
+						subdirs.add(subdir)
+					elif prune:
+						excluded.append(subdir)
+				elif self._path_filter.should_include(relpath + name, is_file=True):
+					names.append(name)
+		except os.error: return
+		STATS.record('walk', listed - started)
+		STATS.record('filter', time.time() - listed)
+		STATS.count('walk.dirs')
+		STATS.count('walk.entries', len(entries))
+
+		for subdir in known_subdirs:
+			if subdir not in subdirs:
+				self._event_queue.put(Event(base=subdir, event=Event.REMOVED, exists=False))
+		for subdir in excluded:
+			if subdir not in known_subdirs:
+				self._event_queue.put(Event(base=subdir, event=Event.REMOVED, exists=False))
+		self._event_queue.put(Event(base=relpath, event=Event.LISTED, exists=True, mtime=mtime, names=names,
+			rules=rules))
+
+	def rescan(self, relpath):
+		"""walk a directory (by its path in the index) and everything under it again"""
+		self._dir_queue.put((self._roots.absolute(relpath), False))
+
+	def rescan_dir(self, relpath):
+		"""list a single directory again (but not its subdirectories), or drop it if it's gone"""
+		path = self._roots.absolute(relpath)
+		try:
+			mtime = os.stat(path).st_mtime
+			names = [name for name, is_dir in self._list(path)
+				if not is_dir and self._path_filter.should_include(relpath + name, is_file=True)]
+		except os.error, e:
+			if e.errno == errno.ENOENT:
+				self._event_queue.put(Event(base=relpath, event=Event.REMOVED, exists=False))
+			return
+		self._event_queue.put(Event(base=relpath, event=Event.LISTED, exists=True, mtime=mtime, names=names,
+			rules=self._path_filter.rules_stamp(relpath)))
+
+	def _list(self, path):
+		"""(name, is_dir) for each entry in `path`"""
+		if scandir is not None:
+			for entry in scandir(path):
 				try:
-					if os.path.isdir(os.path.join(root, name)):
-						self._dir_queue.put((os.path.join(root, name), True))
-					else:
-						self.add_file(root, name)
+					# uses the d_type from the listing where the filesystem provides it
+					yield entry.name, entry.is_dir()
+				except os.error: continue
+		else:
+			for name in os.listdir(path):
+				try:
+					yield name, os.path.isdir(os.path.join(path, name))
 				except os.error: continue
-		except os.error: pass
 
 
 class Event(object):
-	MOVED_TO = 'MOVED_TO'
-	MOVED_FROM = 'MOVED_FROM'
+	MOVED = 'MOVED'
 	ADDED = 'ADDED'
 	REMOVED = 'REMOVED'
+	LISTED = 'LISTED'
+	# files known to exist (from git's index), which don't replace the directory's listing
+	SEEDED = 'SEEDED'
 
-	def __init__(self, base, event, exists, name=None):
+	def __init__(self, base, event, exists, name=None, mtime=None, names=None, dest_base=None, dest_name=None,
+			rules=None):
 		self.base = base
 		self.name = name
 		self.event = event
 		self.exists = exists
+		self.mtime = mtime
+		# (of a listing) the path filter's rules_stamp for the directory
+		self.rules = rules
+		self.names = names
+		self.dest_base = dest_base
+		self.dest_name = dest_name
 	
 	def __repr__(self):
+		if self.is_move:
+			return "%s -> %s" % (self.path, self.dest_path)
 		return "%s %s%s"% (
 				"+" if self.exists else "-",
 				self.path,
@@ -108,40 +266,246 @@ class Event(object):
 	
 	def _is_dir(self): return self.name is None
 	is_dir = property(_is_dir)
+
+	def _is_seed(self): return self.event == Event.SEEDED
+	is_seed = property(_is_seed)
+
+	def _get_size(self):
+		return 1 if self.names is None else len(self.names)
+	size = property(_get_size)
 	
 	def _get_relative_path(self):
 		return os.path.join(self.base, self.name or '')
 	path = property(_get_relative_path)
 
+	def _is_move(self): return self.dest_base is not None
+	is_move = property(_is_move)
+
+	def _get_dest_path(self):
+		if self.dest_base is None: return None
+		return os.path.join(self.dest_base, self.dest_name or '')
+	dest_path = property(_get_dest_path)
+
+def _split(path):
+	"""(directory with a trailing separator, name) of a relative file path"""
+	base, name = os.path.split(path)
+	return (base + os.path.sep if base else ''), name
+
+class EventCoalescer(object):
+	"""
+	Sits between the filesystem observer and the DB, so that the observer
+	never blocks: its events are collected here, and handed on by a thread
+	of our own (which blocks instead, when the DB falls behind). Meanwhile,
+	 - only the latest event for each file is kept, and a file that's
+	   created and deleted again is forgotten altogether
+	 - a rename replaces the events for its destination, or becomes an
+	   addition there if the file was only just created
+	 - a burst of events in one directory becomes a rescan of it
+	Directory events and rescans keep their place among the file events.
+	"""
+	def __init__(self, event_queue, directory_queue, rescan):
+		self._event_queue = event_queue
+		self._directory_queue = directory_queue
+		# lists a single directory (relative to the root) into the event queue
+		self._rescan = rescan
+		self._lock = Condition()
+		self._pending = []
+		self._barrier()
+
+	def _barrier(self):
+		"""nothing before this point may be merged with anything after it"""
+		# file path -> (index in _pending, whether the file is new)
+		self._files = {}
+		# directory -> paths of its pending file events
+		self._dir_files = {}
+		# directories with a pending rescan, which absorb their file events
+		self._rescanning = set()
+
+	def start(self):
+		thread = Thread(target=self._run, name="[coalescer] events")
+		thread.daemon = True
+		thread.start()
+
+	def add(self, event, created=False):
+		"""
+		(observer thread) queue an event, without blocking. `created` is
+		only for a file the observer saw being created, which is the only
+		kind that can be forgotten again (a rename's destination, say,
+		may well have been indexed before it was replaced).
+		"""
+		STATS.count('coalesce.in')
+		with self._lock:
+			if event.is_dir:
+				self._pending.append(event)
+				self._barrier()
+			elif event.is_move:
+				self._add_move(event)
+			else:
+				self._add_file(event.path, event.exists, created)
+			self._lock.notify()
+
+	def rescan(self, path, prune=False):
+		"""queue a (recursive) rescan of an absolute directory path, after the events before it"""
+		with self._lock:
+			self._pending.append((path, True, prune))
+			self._barrier()
+			self._lock.notify()
+
+	def _forget(self, path, drop=False):
+		"""stop merging events with the pending one for `path` (dropping it, if `drop`)"""
+		entry = self._files.pop(path, None)
+		if entry is None:
+			return
+		if drop:
+			self._pending[entry[0]] = None
+		self._dir_files.get(_split(path)[0], set()).discard(path)
+
+	def _add_move(self, event):
+		src, dest = event.path, event.dest_path
+		if _split(src)[0] in self._rescanning or _split(dest)[0] in self._rescanning:
+			# (the rescan sees to its side of the move)
+			self._add_file(src, exists=False)
+			self._add_file(dest, exists=True)
+			return
+		if self._files.get(src, (None, False))[1]:
+			# created since the barrier, so it need only be added where it
+			# ended up (and a temporary file saved over another one vanishes)
+			self._add_file(src, exists=False)
+			self._add_file(dest, exists=True)
+			return
+		# the move replaces whatever was pending for its destination, and
+		# (being applied in place) nothing after it is merged with it
+		self._forget(dest, drop=True)
+		self._forget(src)
+		self._pending.append(event)
+
+	def _add_file(self, path, exists, created=False):
+		base, name = _split(path)
+		if base in self._rescanning:
+			return
+		# (whether it's new is decided by its first event since the barrier)
+		index, is_new = self._files.get(path, (None, created))
+		if index is not None:
+			self._pending[index] = None
+		if not exists and is_new:
+			# created and deleted again since the last barrier
+			self._forget(path)
+			return
+		self._files[path] = (len(self._pending), is_new)
+		self._pending.append(Event(base=base, name=name, event=Event.ADDED if exists else Event.REMOVED, exists=exists))
+		paths = self._dir_files.setdefault(base, set())
+		paths.add(path)
+		if len(paths) > STORM_EVENTS:
+			STATS.count('coalesce.rescans')
+			for path in paths:
+				self._pending[self._files.pop(path)[0]] = None
+			del self._dir_files[base]
+			self._rescanning.add(base)
+			self._pending.append((base, False, False))
+
+	def _run(self):
+		while True:
+			with self._lock:
+				while not self._pending:
+					self._lock.wait()
+			# let a burst gather
+			time.sleep(COALESCE_LATENCY)
+			with self._lock:
+				pending = self._pending
+				self._pending = []
+				self._barrier()
+			STATS.depth('coalesced', len(pending))
+			for item in pending:
+				if item is None:
+					continue
+				STATS.count('coalesce.out')
+				if isinstance(item, Event):
+					self._event_queue.put(item)
+				else:
+					path, recursive, prune = item
+					if recursive:
+						self._directory_queue.put((path, prune))
+					else:
+						self._rescan(path)
+
 def handler(which, exists, path_attr='src_path'):
 	def handle_event(self, event):
 		path = self.relative_path(getattr(event, path_attr))
-		if not self.is_dir(event):
+		if not self.is_dir(event) and self._path_filter.should_include(path, is_file=True):
 			logging.debug("event %s occurred to path %s" % (which, path))
 			base, name = os.path.split(path)
-			self._event_queue.put(Event(base=base, name=name, event=which, exists=exists))
+			self._events.add(Event(base=base, name=name, event=which, exists=exists),
+				created=which == Event.ADDED)
 	return handle_event
 
 class FileFinderEventHandler(FileSystemEventHandler):
-	def __init__(self, event_queue, directory_queue, root):
-		self._event_queue = event_queue
-		self._root = root
+	def __init__(self, events, roots, path_filter):
+		# (an EventCoalescer)
+		self._events = events
+		self._roots = roots
+		self._path_filter = path_filter
 
 	def is_dir(self, event):
 		return event.is_directory
+
+	def dispatch(self, event):
+		self._check_ignore_files(event)
+		FileSystemEventHandler.dispatch(self, event)
+
+	def _check_ignore_files(self, event):
+		"""
+		When an ignore file changes, its directory is walked again (pruning
+		what's now excluded), as any of the files or directories under it
+		might have become (un)ignored. The index keeps the rest meanwhile.
+		"""
+		if event.is_directory: return
+		for path in (event.src_path, getattr(event, 'dest_path', None)):
+			if path is None or os.path.basename(path) not in IGNORE_FILES: continue
+			base = self.relative_path(os.path.dirname(path))
+			base = '' if base == os.curdir else base + os.path.sep
+			if self._path_filter.ignore_files_changed(base):
+				logging.info("ignore rules in %s changed, re-reading it" % (base or 'the root',))
+				self._events.rescan(self._roots.absolute(base), prune=True)
 	
 	def relative_path(self, path):
 		if not os.path.isabs(path):
 			return path
-		if path.startswith(self._root):
-			return os.path.relpath(path, self._root)
-		else:
+		relpath = self._roots.relative(path)
+		if relpath is None:
 			logging.warn("non-relative path encountered: %s" % (path,))
-		return path
+			return path
+		return relpath
 
 	def on_moved(self, event):
-		handler(Event.MOVED_FROM, False)
-		handler(Event.MOVED_TO, True, 'dest_path')
+		"""
+		A rename within the index becomes a single MOVED event, which the DB
+		applies in place. Moves into or out of excluded paths are
+		treated as a removal or addition instead.
+		"""
+		src = self.relative_path(event.src_path)
+		dest = self.relative_path(event.dest_path)
+		logging.debug("event %s occurred to path %s -> %s" % (Event.MOVED, src, dest))
+		is_dir = self.is_dir(event)
+		src_included = self._path_filter.should_include(src, is_file=not is_dir)
+		dest_included = self._path_filter.should_include(dest, is_file=not is_dir)
+		if is_dir:
+			if not dest_included:
+				self._events.add(Event(base=src + os.path.sep, event=Event.REMOVED, exists=False))
+			elif not src_included:
+				self._events.rescan(event.dest_path)
+			else:
+				self._events.add(Event(base=src + os.path.sep, event=Event.MOVED, exists=True,
+					dest_base=dest + os.path.sep))
+		else:
+			base, name = os.path.split(src)
+			dest_base, dest_name = os.path.split(dest)
+			if not dest_included:
+				self._events.add(Event(base=base, name=name, event=Event.REMOVED, exists=False))
+			elif not src_included:
+				self._events.add(Event(base=dest_base, name=dest_name, event=Event.ADDED, exists=True))
+			else:
+				self._events.add(Event(base=base, name=name, event=Event.MOVED, exists=True,
+					dest_base=dest_base, dest_name=dest_name))
 	on_created = handler(Event.ADDED, True)
 	on_deleted = handler(Event.REMOVED, False)
 
@@ -14,7 +14,7 @@ setup(
 	author='Tim Cuthbertson',
 	author_email='tim3d.junk+findfiles@gmail.com',
 	url='http://gfxmonk.net/dist/0install/file-finder.xml',
-	packages=find_packages(exclude=["test"]),
+	packages=find_packages(exclude=["test", "benchmarks"]),
 	
 	classifiers=[
 		"License :: OSI Approved :: BSD License",